@@ -0,0 +1,98 @@
+"""
+background analysis
+
+Runs engine searches in a separate process so the pygame loop keeps its frame rate. Every
+completed iteration is streamed back over a queue, and a search is dropped as soon as the
+position it was started for is replaced or stopped.
+"""
+import multiprocessing
+import queue
+import typing
+
+import engine
+import rules
+
+
+class AnalysisUpdate(typing.NamedTuple):
+    job: int
+    side: int  # side to move in the analysed position
+    result: engine.SearchResult
+
+    @property
+    def text(self) -> str:
+        # scores are shown from White's point of view, like most chess interfaces do
+        score = self.result.score if self.side == rules.WHITE else -self.result.score
+        if abs(score) > engine.MATE_THRESHOLD:
+            score_text = engine.format_score(score)
+        else:
+            score_text = f'{score / 100:+.2f}'
+        pv = ' '.join(str(move) for move in self.result.pv[:6])
+        return f'depth {self.result.depth} {score_text} {pv}'
+
+
+class Analysis:
+    def __init__(self, movetime: float = 0.0):
+        """
+        :param movetime: seconds to analyse each position, 0 to keep going until stopped
+        """
+        self.movetime = movetime
+        # spawn rather than fork so the worker does not inherit the pygame display
+        context = multiprocessing.get_context('spawn')
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.current_job = context.Value('i', 0)
+        self.process = context.Process(target=_run_worker, args=(self.jobs, self.results, self.current_job),
+                                       daemon=True)
+        self.process.start()
+
+    def start(self, state: rules.BoardState):
+        """
+        Start analysing state, dropping whatever search was running
+        :param state:
+        :return:
+        """
+        root = state.copy()
+        root.history = []
+        with self.current_job.get_lock():
+            self.current_job.value += 1
+            job = self.current_job.value
+        self.jobs.put((job, root, self.movetime))
+
+    def stop(self):
+        with self.current_job.get_lock():
+            self.current_job.value += 1
+
+    def poll(self) -> typing.Optional[AnalysisUpdate]:
+        """
+        Latest update for the current search without blocking, None if nothing new arrived
+        :return:
+        """
+        latest = None
+        while True:
+            try:
+                update = self.results.get_nowait()
+            except queue.Empty:
+                return latest
+            if update.job == self.current_job.value:
+                latest = update
+
+    def close(self):
+        self.stop()
+        self.jobs.put(None)
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def _run_worker(jobs: multiprocessing.Queue, results: multiprocessing.Queue, current_job):
+    searcher = engine.Engine()
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, state, movetime = job
+        if current_job.value != job_id:
+            continue  # replaced before it started
+        searcher.search(state, movetime=movetime,
+                        on_iteration=lambda result: results.put(AnalysisUpdate(job_id, state.side, result)),
+                        should_stop=lambda: current_job.value != job_id)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+headless benchmark and regression suite
+
+Times the rules hot paths over the perft reference positions (plus a mate and a stalemate) and,
+with the SDL dummy video driver, the game's move clicks, drawing, reset and startup. Every
+benchmark reports seconds per operation, the best of several repeats, and results are written
+as JSON along with the rules counters each group ran up. Given a baseline written by an earlier
+run, benchmarks slower than it by more than the threshold are reported and the exit status is 1.
+    python3 bench.py --save-baseline                    record bench_baseline.json
+    python3 bench.py --threshold 0.2                    compare against it, 20% allowed
+    python3 bench.py --only rules --threshold-for ui.startup=1.0
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import typing
+
+import metrics
+import perft
+import rules
+
+DEFAULT_OUTPUT = 'bench_results.json'
+DEFAULT_BASELINE = 'bench_baseline.json'
+DEFAULT_THRESHOLD = 0.25  # fraction slower than the baseline that still passes
+DEFAULT_REPEAT = 5
+MIN_BATCH_SECONDS = 0.05  # calls are batched until one batch takes about this long
+
+EXTRA_POSITIONS = [
+    ('fools_mate', 'rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3'),
+    ('stalemate', '7k/5Q2/6K1/8/8/8/8/8 b - - 0 1'),
+]
+
+
+class BenchResult(typing.NamedTuple):
+    seconds: float  # per operation, best repeat
+    operations: int  # operations timed in each repeat
+
+
+def measure(run: typing.Callable[[], typing.Any], operations: int, repeat: int) -> BenchResult:
+    """
+    Best time per operation of run, called enough times per repeat to be measurable
+    :param run: performs operations operations per call
+    :param operations:
+    :param repeat:
+    :return:
+    """
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_BATCH_SECONDS or calls >= 1 << 20:
+            break
+        calls *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        best = min(best, time.perf_counter() - start)
+    return BenchResult(best / (calls * operations), calls * operations)
+
+
+def reference_states() -> typing.List[rules.BoardState]:
+    positions = [(name, fen) for name, fen, _ in perft.REFERENCE_POSITIONS] + EXTRA_POSITIONS
+    return [rules.BoardState.from_fen(fen) for _, fen in positions]
+
+
+def rules_benchmarks(repeat: int) -> typing.Dict[str, BenchResult]:
+    states = reference_states()
+    results = {}
+    for kind in range(rules.PAWN, rules.KING + 1):
+        pairs = [(state, from_sq, to_sq) for state in states
+                 for color in (rules.WHITE, rules.BLACK)
+                 for from_sq in rules.iter_bits(state.bitboards[rules.piece_code(color, kind)])
+                 for to_sq in range(64)]
+        if not pairs:
+            continue
+
+        def can_move(pairs=pairs):
+            for state, from_sq, to_sq in pairs:
+                state.can_move(from_sq, to_sq)
+        results[f'rules.can_move.{rules.PIECE_NAMES[kind].lower()}'] = measure(can_move, len(pairs), repeat)
+
+    moves = [(state, move) for state in states for move in state.pseudo_legal_moves()]
+
+    def leaves_king_in_check():
+        for state, move in moves:
+            state.leaves_king_in_check(move.from_sq, move.to_sq)
+    results['rules.leaves_king_in_check'] = measure(leaves_king_in_check, len(moves), repeat)
+
+    def in_check():
+        for state in states:
+            state.in_check(rules.WHITE)
+            state.in_check(rules.BLACK)
+    results['rules.in_check'] = measure(in_check, len(states) * 2, repeat)
+
+    def outcome():
+        for state in states:
+            state.outcome()
+    results['rules.outcome'] = measure(outcome, len(states), repeat)
+
+    def legal_moves():
+        for state in states:
+            for _ in state.legal_moves():
+                pass
+    results['rules.legal_moves'] = measure(legal_moves, len(states), repeat)
+
+    legal = [(state, list(state.legal_moves())) for state in states]
+
+    def make_unmake():
+        for state, state_moves in legal:
+            for move in state_moves:
+                state.make_move(*move)
+                state.unmake_move()
+    results['rules.make_unmake'] = measure(make_unmake, sum(len(state_moves) for _, state_moves in legal), repeat)
+    return results
+
+
+def ui_benchmarks(repeat: int) -> typing.Dict[str, BenchResult]:
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    import main as ui  # imported here so the rules benchmarks run without pygame
+
+    logging.getLogger(ui.__name__).setLevel(logging.WARNING)  # one line per click would swamp the timing
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        ui.JOURNAL_FILENAME = os.path.join(directory, 'bench.journal')  # keep the player's saved game
+        no_tablebases = os.path.join(directory, 'tablebases')
+
+        def startup():
+            game = ui.Game(ui.SCREEN_WIDTH, ui.SCREEN_HEIGHT, tablebase_directory=no_tablebases)
+            game.journal.close()
+        results['ui.startup'] = measure(startup, 1, repeat)
+
+        game = ui.Game(ui.SCREEN_WIDTH, ui.SCREEN_HEIGHT, tablebase_directory=no_tablebases)
+
+        def load_icons():
+            assets = ui.AssetCache(game.icon_config, game.board.position_size)
+            for color in (rules.WHITE, rules.BLACK):
+                for kind in range(rules.PAWN, rules.KING + 1):
+                    assets.piece(rules.piece_code(color, kind))
+        results['ui.load_icons'] = measure(load_icons, 1, repeat)
+
+        results['ui.reset'] = measure(game._reset, 1, repeat)
+
+        positions = game.board.positions
+        # knights out and back, so the cycle can run any number of times
+        shuffle = [((6, 0), (5, 2)), ((6, 7), (5, 5)), ((5, 2), (6, 0)), ((5, 5), (6, 7))]
+        clicks = [(positions[x][y].rect.center, positions[to_x][to_y].rect.center)
+                  for (x, y), (to_x, to_y) in shuffle]
+
+        def act_move_cycle():
+            for select, target in clicks:
+                game._act(select, 1)
+                game._act(target, 1)
+            state = game.board_state
+            assert not game.game_over and len(state.history) == len(clicks), game.check_text
+            # back at the start, forget the cycle so repeated runs never draw by repetition or fifty moves
+            state.history.clear()
+            state.halfmove_clock = 0
+            state.repetitions = {state.hash: 1}
+        game._reset()
+        results['ui.act_move'] = measure(act_move_cycle, len(clicks), repeat)
+
+        game._reset()
+
+        def draw_full():
+            game.drawn_squares = None
+            game._draw()
+        results['ui.draw_full'] = measure(draw_full, 1, repeat)
+        results['ui.draw_unchanged'] = measure(game._draw, 1, repeat)
+        game.journal.close()
+    ui.pygame.quit()
+    return results
+
+
+def compare(results: typing.Dict[str, BenchResult], baseline: typing.Dict[str, dict], threshold: float,
+            thresholds: typing.Dict[str, float]) -> typing.List[str]:
+    """
+    Benchmarks slower than the baseline by more than their threshold
+    :param results:
+    :param baseline: the results section of a saved run
+    :param threshold: allowed slowdown as a fraction, 0.25 is 25% slower
+    :param thresholds: overrides per benchmark name
+    :return: one description per regression
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        allowed = thresholds.get(name, threshold)
+        before = baseline[name]['seconds']
+        change = result.seconds / before - 1 if before > 0 else 0.0
+        if change > allowed:
+            regressions.append(f'{name}: {before * 1e6:.2f}us -> {result.seconds * 1e6:.2f}us '
+                               f'({change:+.0%}, {allowed:.0%} allowed)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument('--only', choices=['rules', 'ui'], help='run one group of benchmarks')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help=f'repeats per benchmark (default {DEFAULT_REPEAT})')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help=f'results file (default {DEFAULT_OUTPUT})')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help=f'results to compare against (default {DEFAULT_BASELINE})')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file as well')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'allowed slowdown against the baseline, as a fraction (default {DEFAULT_THRESHOLD})')
+    parser.add_argument('--threshold-for', action='append', default=[], metavar='NAME=FRACTION',
+                        help='allowed slowdown for one benchmark, may be given more than once')
+    args = parser.parse_args()
+    thresholds = {}
+    for override in args.threshold_for:
+        name, _, fraction = override.partition('=')
+        try:
+            thresholds[name] = float(fraction)
+        except ValueError:
+            parser.error(f'--threshold-for expects NAME=FRACTION, got {override}')
+
+    results = {}
+    counters = {}
+    for group, benchmarks in (('rules', rules_benchmarks), ('ui', ui_benchmarks)):
+        if args.only in (None, group):
+            metrics.reset()  # so each group's counters are its own
+            results.update(benchmarks(args.repeat))
+            counters[group] = metrics.snapshot()['counters']
+    for name, result in sorted(results.items()):
+        print(f'{name:32} {result.seconds * 1e6:12.2f}us  ({result.operations} ops per repeat)')
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': {name: result._asdict() for name, result in sorted(results.items())},
+        'counters': counters,
+    }
+    for filename in [args.output] + ([args.baseline] if args.save_baseline else []):
+        with open(filename, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+    regressions = compare(results, baseline, args.threshold, thresholds)
+    if regressions:
+        print(f'{len(regressions)} regression(s) against {args.baseline}:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+    print(f'no regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+memory-mapped opening book
+
+Books use the Polyglot layout: 16-byte big-endian entries of key (8 bytes), move (2 bytes),
+weight (2 bytes) and learn (4 bytes), sorted by key. Moves are encoded the Polyglot way, with
+castling written as the king taking its own rook. The key is BoardState.hash rather than the
+Polyglot Random64 key, so books must be built with this module; published .bin books will not
+match.
+
+The file is memory-mapped and binary searched, so opening one costs the same whatever its size.
+Commands:
+    build games.pgn book.bin        book of the first moves of every valid game
+    probe book.bin --fen FEN        list the book moves of a position
+"""
+import argparse
+import mmap
+import os
+import random
+import struct
+import time
+import typing
+
+import pgn
+import rules
+
+ENTRY = struct.Struct('>QHHI')
+MAX_WEIGHT = 0xffff
+RESULT_WEIGHTS = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1), '*': (1, 1)}  # (white, black)
+
+
+class BookEntry(typing.NamedTuple):
+    move: rules.Move
+    weight: int
+
+
+def encode_move(state: rules.BoardState, move: rules.Move) -> int:
+    from_sq, to_sq, promotion = move
+    if state.squares[from_sq] & 7 == rules.KING and abs(to_sq - from_sq) == 2:
+        to_sq = from_sq + 3 if to_sq > from_sq else from_sq - 4
+    return (promotion - 1 if promotion else 0) << 12 | from_sq << 6 | to_sq
+
+
+def decode_move(state: rules.BoardState, value: int) -> rules.Move:
+    from_sq = value >> 6 & 63
+    to_sq = value & 63
+    promotion = value >> 12 & 7
+    code = state.squares[from_sq]
+    if code & 7 == rules.KING and state.squares[to_sq] == rules.piece_code(code >> 3, rules.ROOK):
+        to_sq = from_sq + 2 if to_sq > from_sq else from_sq - 2
+    return rules.Move(from_sq, to_sq, promotion + 1 if promotion else rules.EMPTY)
+
+
+class OpeningBook:
+    def __init__(self, filename: str):
+        self.file = open(filename, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = size // ENTRY.size
+        # mmap can't map an empty file
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def entries(self, state: rules.BoardState) -> typing.List[BookEntry]:
+        """
+        Legal book moves of the side to move, heaviest first
+        :param state:
+        :return:
+        """
+        key = state.hash.to_bytes(8, 'big')
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * ENTRY.size
+            if self.map[start:start + 8] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        for index in range(low, self.count):
+            entry_key, value, weight, _ = ENTRY.unpack_from(self.map, index * ENTRY.size)
+            if entry_key != state.hash:
+                break
+            move = decode_move(state, value)
+            if state.is_legal(move.from_sq, move.to_sq):
+                entries.append(BookEntry(move, weight))
+        entries.sort(key=lambda entry: -entry.weight)
+        return entries
+
+    def choose(self, state: rules.BoardState, chooser: random.Random = None) -> typing.Optional[rules.Move]:
+        """
+        Pick a book move at random in proportion to its weight
+        :param state:
+        :param chooser: source of randomness, the random module when None
+        :return: None when the position is not in the book
+        """
+        entries = self.entries(state)
+        if not entries:
+            return None
+        chooser = chooser or random
+        total = sum(entry.weight for entry in entries)
+        if not total:
+            return chooser.choice(entries).move
+        pick = chooser.randrange(total)
+        for entry in entries:
+            pick -= entry.weight
+            if pick < 0:
+                return entry.move
+        return entries[-1].move
+
+    def close(self):
+        if self.count:
+            self.map.close()
+        self.file.close()
+
+
+def build_book(pgn_filename: str, book_filename: str, max_plies: int = 20, min_games: int = 1) -> int:
+    """
+    Build a book from the opening moves of every game in a PGN file that replays cleanly
+    :param pgn_filename:
+    :param book_filename:
+    :param max_plies: how deep into each game moves are taken
+    :param min_games: leave out moves played in fewer games than this
+    :return: number of entries written
+    """
+    weights = {}
+    games = {}
+    for replayed in pgn.replay_games(pgn.open_games(pgn_filename)):
+        if replayed.error is not None:
+            continue
+        result_weights = RESULT_WEIGHTS.get(replayed.game.result, (1, 1))
+        state = pgn.starting_state(replayed.game.headers)
+        for move in replayed.moves[:max_plies]:
+            key = (state.hash, encode_move(state, move))
+            weights[key] = weights.get(key, 0) + result_weights[state.side]
+            games[key] = games.get(key, 0) + 1
+            state.make_move(*move)
+    with open(book_filename, 'wb') as book:
+        count = 0
+        for key in sorted(weights):
+            if games[key] < min_games:
+                continue
+            book.write(ENTRY.pack(key[0], key[1], min(weights[key], MAX_WEIGHT), 0))
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    build = subparsers.add_parser('build', help='build a book from a PGN file')
+    build.add_argument('pgn')
+    build.add_argument('book')
+    build.add_argument('--plies', type=int, default=20, help='plies taken from each game (default 20)')
+    build.add_argument('--min-games', type=int, default=1, help='leave out moves played in fewer games (default 1)')
+    probe = subparsers.add_parser('probe', help='list the book moves of a position')
+    probe.add_argument('book')
+    probe.add_argument('--fen', default=rules.START_FEN, help='position to look up (default the start)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        count = build_book(args.pgn, args.book, args.plies, args.min_games)
+        print(f'{count} entries written in {time.perf_counter() - start:.2f}s')
+        return
+    state = rules.BoardState.from_fen(args.fen)
+    with OpeningBook(args.book) as book:
+        start = time.perf_counter()
+        entries = book.entries(state)
+        elapsed = time.perf_counter() - start
+    total = sum(entry.weight for entry in entries) or 1
+    print(f'{len(entries)} book moves among {len(book)} entries, found in {elapsed * 1e6:.0f}us')
+    for entry in entries:
+        print(f'  {pgn.move_to_san(state, entry.move):8} weight {entry.weight:5} ({entry.weight / total:.0%})')
+
+
+if __name__ == '__main__':
+    main()
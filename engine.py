@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+computer opponent
+
+Negamax alpha-beta search with iterative deepening, quiescence search, a transposition table
+keyed by zobrist hash and move ordering from the table move, captures, killers and history.
+Searches stop on a time or node budget and report depth and nodes/sec. Positions covered by
+endgame tablebases are looked up instead of searched. ParallelEngine splits the root moves
+across a process pool so a search can use every core.
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+import typing
+
+import evaluation
+import rules
+import tablebase
+
+MATE_SCORE = 100000
+MATE_THRESHOLD = MATE_SCORE - 1000
+INFINITY = MATE_SCORE + 1
+CHECK_INTERVAL = 255  # nodes between time, budget and stop checks, minus one
+
+# transposition table bound types
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+class SearchResult(typing.NamedTuple):
+    move: typing.Optional[rules.Move]
+    score: int  # centipawns from the side to move's point of view
+    depth: int
+    nodes: int
+    seconds: float
+    pv: typing.List[rules.Move]
+
+    @property
+    def nodes_per_second(self) -> float:
+        return self.nodes / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def score_text(self) -> str:
+        return format_score(self.score)
+
+    def __str__(self):
+        return (f'depth {self.depth} score {self.score_text} nodes {self.nodes} time {self.seconds:.2f}s '
+                f'nps {self.nodes_per_second:,.0f} pv {" ".join(str(move) for move in self.pv)}')
+
+
+def format_score(score: int) -> str:
+    if abs(score) > MATE_THRESHOLD:
+        moves = (MATE_SCORE - abs(score) + 1) // 2
+        return f'mate {moves if score > 0 else -moves}'
+    return f'cp {score}'
+
+
+class SearchStopped(Exception):
+    pass
+
+
+class Engine:
+    def __init__(self, movetime: float = 1.0, max_nodes: int = None, max_depth: int = 64, table_size: int = 1 << 20,
+                 tablebases: tablebase.Tablebases = None):
+        """
+        :param movetime: seconds per move
+        :param max_nodes: node budget per move, unlimited if None
+        :param max_depth: deepest iteration to run
+        :param table_size: transposition table entries kept before it is cleared
+        :param tablebases: endgame tables probed instead of searching the positions they cover
+        """
+        self.movetime = movetime
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.table_size = table_size
+        self.tablebases = tablebases or None
+        self.table: typing.Dict[int, tuple] = {}  # hash -> (depth, score, bound, move)
+        self.killers: typing.List[typing.List[rules.Move]] = []
+        self.history: typing.Dict[rules.Move, int] = {}
+        self.nodes = 0
+        self._deadline = 0.0
+        self._node_limit = None
+        self._root_move = None
+        self._root_moves = None
+        self._should_stop = None
+
+    def search(self, state: rules.BoardState, movetime: float = None, max_nodes: int = None, max_depth: int = None,
+               on_iteration: typing.Callable[[SearchResult], None] = None,
+               root_moves: typing.Sequence[rules.Move] = None,
+               should_stop: typing.Callable[[], bool] = None) -> SearchResult:
+        """
+        Find the best move for the side to move, deepening one ply at a time until the budget runs out
+        :param state: searched on a copy, so the caller's position is left alone
+        :param movetime: seconds, defaults to the engine's movetime
+        :param max_nodes: defaults to the engine's max_nodes
+        :param max_depth: defaults to the engine's max_depth
+        :param on_iteration: called with the result of every completed iteration
+        :param root_moves: only consider these moves at the root
+        :param should_stop: polled during the search, which ends as soon as it returns True
+        :return: result of the deepest completed iteration
+        """
+        state = state.copy()
+        movetime = self.movetime if movetime is None else movetime
+        max_depth = self.max_depth if max_depth is None else max_depth
+        start = time.perf_counter()
+        self._deadline = start + movetime if movetime else float('inf')
+        self._node_limit = self.max_nodes if max_nodes is None else max_nodes
+        self.nodes = 0
+        self.killers = [[None, None] for _ in range(max_depth + 64)]
+        self.history = {}
+        self._root_moves = root_moves
+        self._should_stop = should_stop
+        moves = list(state.legal_moves()) if root_moves is None else list(root_moves)
+        result = SearchResult(moves[0] if moves else None, 0, 0, 0, 0.0, moves[:1])
+        if not moves or (len(moves) == 1 and root_moves is None):
+            if moves and on_iteration is not None:
+                on_iteration(result)  # a forced move is still a line for whoever is watching
+            return result
+        if self.tablebases is not None and root_moves is None:
+            found = self.tablebases.best_move(state)
+            if found is not None:
+                move, probe = found
+                result = SearchResult(move, _tablebase_score(probe, 0), 0, 0, time.perf_counter() - start, [move])
+                if on_iteration is not None:
+                    on_iteration(result)
+                return result
+        for depth in range(1, max_depth + 1):
+            self._root_move = None
+            try:
+                score = self._negamax(state, depth, -INFINITY, INFINITY, 0)
+            except SearchStopped:
+                if self._root_move is not None and self._root_move != result.move:
+                    result = result._replace(move=self._root_move, pv=[self._root_move])
+                break
+            elapsed = time.perf_counter() - start
+            result = SearchResult(self._root_move, score, depth, self.nodes, elapsed,
+                                  self._principal_variation(state, depth))
+            if on_iteration is not None:
+                on_iteration(result)
+            if abs(score) > MATE_THRESHOLD or time.perf_counter() + elapsed > self._deadline:
+                break  # mate found, or the next iteration won't finish in time
+        return result._replace(nodes=self.nodes, seconds=time.perf_counter() - start)
+
+    def _check_limits(self):
+        if time.perf_counter() >= self._deadline or (self._node_limit is not None and self.nodes >= self._node_limit):
+            raise SearchStopped()
+        if self._should_stop is not None and self._should_stop():
+            raise SearchStopped()
+
+    def _negamax(self, state: rules.BoardState, depth: int, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if not self.nodes & CHECK_INTERVAL:
+            self._check_limits()
+        if ply and (state.halfmove_clock >= 100 or state.repetitions.get(state.hash, 0) >= 2):
+            return 0
+        if self.tablebases is not None and ply:
+            probe = self.tablebases.probe(state)
+            if probe is not None:
+                return _tablebase_score(probe, ply)
+        in_check = state.in_check(state.side)
+        if in_check:
+            depth += 1
+        if depth <= 0:
+            return self._quiescence(state, alpha, beta, ply)
+
+        alpha_original = alpha
+        table_move = None
+        entry = self.table.get(state.hash)
+        if entry is not None:
+            entry_depth, entry_score, bound, table_move = entry
+            if ply and entry_depth >= depth:
+                entry_score = _score_from_table(entry_score, ply)
+                if bound == EXACT:
+                    return entry_score
+                if bound == LOWER:
+                    alpha = max(alpha, entry_score)
+                else:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+
+        moves = list(state.legal_moves()) if ply or self._root_moves is None else list(self._root_moves)
+        if not moves:
+            return -MATE_SCORE + ply if in_check else 0
+        best_score = -INFINITY
+        best_move = None
+        for move in self._order_moves(state, moves, table_move, ply):
+            state.make_move(*move)
+            score = -self._negamax(state, depth - 1, -beta, -alpha, ply + 1)
+            state.unmake_move()
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if ply == 0:
+                    self._root_move = move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if not _is_capture(state, move):
+                            killers = self.killers[ply]
+                            if killers[0] != move:
+                                killers[1] = killers[0]
+                                killers[0] = move
+                            self.history[move] = self.history.get(move, 0) + depth * depth
+                        break
+
+        if best_score <= alpha_original:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        if len(self.table) >= self.table_size:
+            self.table.clear()
+        self.table[state.hash] = (depth, _score_to_table(best_score, ply), bound, best_move)
+        return best_score
+
+    def _quiescence(self, state: rules.BoardState, alpha: int, beta: int, ply: int) -> int:
+        """
+        Keep searching captures and promotions (or every evasion when in check) until the position is quiet
+        """
+        self.nodes += 1
+        if not self.nodes & CHECK_INTERVAL:
+            self._check_limits()
+        in_check = state.in_check(state.side)
+        if in_check:
+            best_score = -INFINITY
+        else:
+            best_score = evaluation.evaluate_for_side(state)  # stand pat
+            if best_score >= beta:
+                return best_score
+            alpha = max(alpha, best_score)
+        moves = list(state.legal_moves())
+        if not moves:
+            return -MATE_SCORE + ply if in_check else 0
+        if not in_check:
+            moves = [move for move in moves if move.promotion or _is_capture(state, move)]
+        for move in self._order_moves(state, moves, None, ply):
+            state.make_move(*move)
+            score = -self._quiescence(state, -beta, -alpha, ply + 1)
+            state.unmake_move()
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        return best_score
+
+    def _order_moves(self, state: rules.BoardState, moves: typing.List[rules.Move], table_move: rules.Move,
+                     ply: int) -> typing.List[rules.Move]:
+        squares = state.squares
+        killers = self.killers[ply] if ply < len(self.killers) else (None, None)
+        history = self.history
+
+        def key(move: rules.Move) -> int:
+            if move == table_move:
+                return 1 << 30
+            victim = squares[move.to_sq]
+            if victim:
+                # most valuable victim, least valuable attacker
+                return (1 << 20) + evaluation.PIECE_VALUES[victim & 7] * 8 - (squares[move.from_sq] & 7)
+            if move.promotion:
+                return (1 << 19) + move.promotion
+            if move == killers[0] or move == killers[1]:
+                return 1 << 18
+            return history.get(move, 0)
+
+        return sorted(moves, key=key, reverse=True)
+
+    def _principal_variation(self, state: rules.BoardState, depth: int) -> typing.List[rules.Move]:
+        pv = []
+        probe = state.copy()
+        while len(pv) < depth:
+            entry = self.table.get(probe.hash)
+            if entry is None or entry[3] is None or entry[3] not in set(probe.legal_moves()):
+                break
+            pv.append(entry[3])
+            probe.make_move(*entry[3])
+        return pv
+
+
+class ParallelEngine:
+    """
+    Root move splitting: the root moves are dealt out across worker processes, each worker runs
+    an iterative deepening Engine search over its share, and the best score at the deepest depth
+    every share completed wins
+    """
+    def __init__(self, workers: int = None, movetime: float = 1.0, max_nodes: int = None, max_depth: int = 64,
+                 tablebase_directory: str = None):
+        """
+        :param workers: processes to search with, defaults to the number of cores
+        :param movetime: seconds per move
+        :param max_nodes: node budget per move, shared between the workers
+        :param max_depth: deepest iteration to run
+        :param tablebase_directory: endgame tables every worker opens and probes, None for no tables
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.movetime = movetime
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.tablebase_directory = tablebase_directory
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+
+    def search(self, state: rules.BoardState, movetime: float = None, max_nodes: int = None, max_depth: int = None,
+               on_iteration: typing.Callable[[SearchResult], None] = None) -> SearchResult:
+        start = time.perf_counter()
+        movetime = self.movetime if movetime is None else movetime
+        max_nodes = self.max_nodes if max_nodes is None else max_nodes
+        max_depth = self.max_depth if max_depth is None else max_depth
+        moves = list(state.legal_moves())
+        if len(moves) <= 1:
+            result = SearchResult(moves[0] if moves else None, 0, 0, 0, 0.0, moves[:1])
+            if moves and on_iteration is not None:
+                on_iteration(result)
+            return result
+        # captures first so every worker gets a mix of forcing and quiet moves
+        moves.sort(key=lambda move: bool(state.squares[move.to_sq]), reverse=True)
+        shares = [moves[index::self.workers] for index in range(self.workers)]
+        shares = [share for share in shares if share]
+        root = state.copy()
+        root.history = []  # workers never unmake past the root, don't ship the undo stack
+        worker_nodes = max_nodes // len(shares) if max_nodes else None
+        futures = [self.pool.submit(_search_share, root, share, movetime, worker_nodes, max_depth,
+                                    self.tablebase_directory) for share in shares]
+        shares = [future.result() for future in futures]
+        nodes = sum(final.nodes for _, final in shares)
+        searched = [iterations for iterations, _ in shares if iterations]
+        if not searched:
+            best = shares[0][1]
+        else:
+            # scores from different depths don't compare, so only the deepest iteration every share finished counts
+            depth = min(iterations[-1].depth for iterations in searched)
+            best = max((next(result for result in iterations if result.depth == depth) for iterations in searched),
+                       key=lambda result: result.score)
+        best = best._replace(nodes=nodes, seconds=time.perf_counter() - start)
+        if on_iteration is not None:
+            on_iteration(best)
+        return best
+
+    def close(self):
+        self.pool.shutdown()
+
+
+_worker_engine: typing.Optional[Engine] = None
+_worker_tablebase_directory: typing.Optional[str] = None
+
+
+def _search_share(state: rules.BoardState, root_moves: typing.Optional[typing.List[rules.Move]], movetime: float,
+                  max_nodes: int = None, max_depth: int = 64, tablebase_directory: str = None
+                  ) -> typing.Tuple[typing.List[SearchResult], SearchResult]:
+    """
+    Search a share of the root moves, or with root_moves None all of them, in a worker process
+    :param tablebase_directory: endgame tables to probe, opened once per process
+    :return: (result of every completed iteration, final result)
+    """
+    global _worker_engine, _worker_tablebase_directory
+    if _worker_engine is None or tablebase_directory != _worker_tablebase_directory:
+        if _worker_engine is not None and _worker_engine.tablebases is not None:
+            _worker_engine.tablebases.close()
+        tablebases = tablebase.Tablebases(tablebase_directory) if tablebase_directory else None
+        _worker_engine = Engine(tablebases=tablebases)  # one per worker process, so its table carries over between moves
+        _worker_tablebase_directory = tablebase_directory
+    iterations = []
+    final = _worker_engine.search(state, movetime, max_nodes, max_depth, on_iteration=iterations.append,
+                                  root_moves=root_moves)
+    return iterations, final
+
+
+def measure_speedup(state: rules.BoardState, depth: int, max_workers: int):
+    """
+    Time a fixed depth search with 1, 2, 4, ... workers and print the speedup over a single process
+    :param state:
+    :param depth:
+    :param max_workers:
+    :return:
+    """
+    baseline = None
+    workers = 1
+    while True:
+        searcher = Engine(movetime=0) if workers == 1 else ParallelEngine(workers, movetime=0)
+        start = time.perf_counter()
+        result = searcher.search(state, max_depth=depth)
+        elapsed = time.perf_counter() - start
+        if workers > 1:
+            searcher.close()
+        baseline = baseline or elapsed
+        print(f'{workers} worker(s): {elapsed:.2f}s, {result.nodes / elapsed:,.0f} nodes/sec, '
+              f'speedup {baseline / elapsed:.2f}x, bestmove {result.move}')
+        if workers >= max_workers:
+            break
+        workers = min(workers * 2, max_workers)
+
+
+def _is_capture(state: rules.BoardState, move: rules.Move) -> bool:
+    return bool(state.squares[move.to_sq]) or (
+        move.to_sq == state.en_passant and state.squares[move.from_sq] & 7 == rules.PAWN)
+
+
+def _tablebase_score(probe: tablebase.Probe, ply: int) -> int:
+    if probe.wdl > 0:
+        return MATE_SCORE - ply - probe.plies
+    if probe.wdl < 0:
+        return -MATE_SCORE + ply + probe.plies
+    return 0
+
+
+def _score_to_table(score: int, ply: int) -> int:
+    # mate scores are stored relative to the node so they stay valid wherever it is reached
+    if score > MATE_THRESHOLD:
+        return score + ply
+    if score < -MATE_THRESHOLD:
+        return score - ply
+    return score
+
+
+def _score_from_table(score: int, ply: int) -> int:
+    if score > MATE_THRESHOLD:
+        return score - ply
+    if score < -MATE_THRESHOLD:
+        return score + ply
+    return score
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--fen', default=rules.START_FEN, help='position to search (default start position)')
+    parser.add_argument('--movetime', type=float, default=5.0, help='seconds to search (default 5)')
+    parser.add_argument('--nodes', type=int, help='node budget')
+    parser.add_argument('--depth', type=int, default=64, help='maximum depth')
+    parser.add_argument('--workers', type=int, default=1, help='search processes (default 1)')
+    parser.add_argument('--tablebases', default=tablebase.DEFAULT_DIRECTORY,
+                        help=f'endgame table directory (default {tablebase.DEFAULT_DIRECTORY})')
+    parser.add_argument('--speedup', action='store_true',
+                        help='time a fixed --depth search with 1 up to --workers processes and report the speedup')
+    args = parser.parse_args()
+
+    state = rules.BoardState.from_fen(args.fen)
+    if args.speedup:
+        measure_speedup(state, min(args.depth, 6), args.workers)
+        return
+    if args.workers > 1:
+        engine = ParallelEngine(args.workers, movetime=args.movetime, max_nodes=args.nodes, max_depth=args.depth,
+                                tablebase_directory=args.tablebases)
+    else:
+        engine = Engine(movetime=args.movetime, max_nodes=args.nodes, max_depth=args.depth,
+                        tablebases=tablebase.Tablebases(args.tablebases))
+    result = engine.search(state, on_iteration=print)
+    print(f'bestmove {result.move} ({result.nodes} nodes in {result.seconds:.2f}s, '
+          f'{result.nodes_per_second:,.0f} nodes/sec)')
+    if args.workers > 1:
+        engine.close()
+
+
+if __name__ == '__main__':
+    main()
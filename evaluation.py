@@ -0,0 +1,116 @@
+"""
+static position evaluation: material plus piece-square tables
+
+Scores are in centipawns from White's point of view unless a function says otherwise.
+"""
+import typing
+
+import rules
+
+PIECE_VALUES = (0, 100, 320, 330, 500, 900, 0)  # indexed by piece kind
+
+# piece-square tables from White's point of view, written as seen from White's side of the board (a8 first)
+_PAWN_TABLE = (
+    0, 0, 0, 0, 0, 0, 0, 0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+    5, 5, 10, 25, 25, 10, 5, 5,
+    0, 0, 0, 20, 20, 0, 0, 0,
+    5, -5, -10, 0, 0, -10, -5, 5,
+    5, 10, 10, -20, -20, 10, 10, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+)
+_KNIGHT_TABLE = (
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0, 0, 0, 0, -20, -40,
+    -30, 0, 10, 15, 15, 10, 0, -30,
+    -30, 5, 15, 20, 20, 15, 5, -30,
+    -30, 0, 15, 20, 20, 15, 0, -30,
+    -30, 5, 10, 15, 15, 10, 5, -30,
+    -40, -20, 0, 5, 5, 0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50,
+)
+_BISHOP_TABLE = (
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 10, 10, 5, 0, -10,
+    -10, 5, 5, 10, 10, 5, 5, -10,
+    -10, 0, 10, 10, 10, 10, 0, -10,
+    -10, 10, 10, 10, 10, 10, 10, -10,
+    -10, 5, 0, 0, 0, 0, 5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20,
+)
+_ROOK_TABLE = (
+    0, 0, 0, 0, 0, 0, 0, 0,
+    5, 10, 10, 10, 10, 10, 10, 5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    0, 0, 0, 5, 5, 0, 0, 0,
+)
+_QUEEN_TABLE = (
+    -20, -10, -10, -5, -5, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 5, 5, 5, 0, -10,
+    -5, 0, 5, 5, 5, 5, 0, -5,
+    0, 0, 5, 5, 5, 5, 0, -5,
+    -10, 5, 5, 5, 5, 5, 0, -10,
+    -10, 0, 5, 0, 0, 0, 0, -10,
+    -20, -10, -10, -5, -5, -10, -10, -20,
+)
+_KING_TABLE = (
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20, 20, 0, 0, 0, 0, 20, 20,
+    20, 30, 10, 0, 0, 10, 30, 20,
+)
+
+
+def _build_square_values() -> typing.List[typing.List[int]]:
+    """
+    Combine material and table bonus into one signed value per piece code and square
+    :return:
+    """
+    tables = (None, _PAWN_TABLE, _KNIGHT_TABLE, _BISHOP_TABLE, _ROOK_TABLE, _QUEEN_TABLE, _KING_TABLE)
+    values = [[0] * 64 for _ in range(15)]
+    for kind in range(rules.PAWN, rules.KING + 1):
+        for sq in range(64):
+            x = sq & 7
+            y = sq >> 3
+            white = PIECE_VALUES[kind] + tables[kind][(7 - y) * 8 + x]
+            black = PIECE_VALUES[kind] + tables[kind][y * 8 + x]  # mirrored vertically
+            values[rules.piece_code(rules.WHITE, kind)][sq] = white
+            values[rules.piece_code(rules.BLACK, kind)][sq] = -black
+    return values
+
+
+SQUARE_VALUES = _build_square_values()  # indexed by piece code, then square
+
+
+def evaluate(state: rules.BoardState) -> int:
+    """
+    Material and piece-square score from White's point of view
+    :param state:
+    :return:
+    """
+    squares = state.squares
+    score = 0
+    for sq in rules.iter_bits(state.occupancy[0] | state.occupancy[1]):
+        score += SQUARE_VALUES[squares[sq]][sq]
+    return score
+
+
+def evaluate_for_side(state: rules.BoardState) -> int:
+    """
+    Score from the point of view of the side to move, as negamax search wants it
+    :param state:
+    :return:
+    """
+    score = evaluate(state)
+    return score if state.side == rules.WHITE else -score
@@ -0,0 +1,163 @@
+"""
+append-only binary game journal
+
+Layout of a journal file:
+    header      b'PCJ2' then the offset of the latest snapshot (8 bytes, big-endian)
+    records     one after another to the end of the file
+A move record is 2 bytes: a clear top bit, the promotion kind (3 bits), then the from and to
+squares (6 bits each). A snapshot record starts with 2 bytes holding SNAPSHOT and is followed
+by the play time (double), the FEN length (2 bytes), the FEN, a count (2 bytes) and that many
+position hashes (8 bytes each): the positions since the last capture or pawn move, which can
+still repeat, so a resumed game keeps counting threefold repetition.
+
+Moves are appended as they are played, so saving costs the same however long the game is.
+Resuming reads the header, the latest snapshot and the moves after it, never the whole file.
+The positions before the snapshot are only kept as hashes, so a resumed game can take back
+the moves after the snapshot but not past it. A record cut short by a crash is dropped and
+overwritten by the next write.
+"""
+import os
+import struct
+import typing
+
+import rules
+
+MAGIC = b'PCJ2'
+HEADER = struct.Struct('>4sQ')
+RECORD = struct.Struct('>H')
+SNAPSHOT_FIELDS = struct.Struct('>dH')
+HASH = struct.Struct('>Q')
+SNAPSHOT = 0x8001
+SNAPSHOT_INTERVAL = 32  # moves between automatic snapshots
+
+
+class Resumed(typing.NamedTuple):
+    state: rules.BoardState
+    playtime: float
+    end: int  # offset just past the last complete record
+    hashes: typing.List[int]  # positions before the snapshot that can still repeat, oldest first
+
+
+def encode_move(move: rules.Move) -> bytes:
+    return RECORD.pack(move.promotion << 12 | move.from_sq << 6 | move.to_sq)
+
+
+def decode_move(value: int) -> rules.Move:
+    return rules.Move(value >> 6 & 63, value & 63, value >> 12 & 7)
+
+
+class Journal:
+    def __init__(self, filename: str, state: rules.BoardState = None, playtime: float = 0.0, end: int = None,
+                 hashes: typing.List[int] = ()):
+        """
+        Start a new journal at state, or with end given, continue an existing one that was resumed. A new
+        journal only replaces the file when its first move is appended, so the saved game survives until then
+        :param filename:
+        :param state: starting position of a new journal
+        :param playtime: seconds already played
+        :param end: offset to continue writing from, as returned by resume
+        :param hashes: positions before the resumed snapshot, as returned by resume
+        """
+        self.filename = filename
+        self.moves_since_snapshot = 0
+        self.hashes = list(hashes)  # positions before the first move of state's history, oldest first
+        self.file = None
+        if end is None:
+            self.start = (state.to_fen(), playtime)
+        else:
+            self.start = None
+            self.file = open(filename, 'r+b')
+            self.file.truncate(end)
+            self.file.seek(end)
+
+    def append_move(self, move: rules.Move):
+        if self.file is None:
+            self.file = open(self.filename, 'w+b')
+            self.file.write(HEADER.pack(MAGIC, 0))
+            fen, playtime = self.start
+            self._write_snapshot(fen, playtime, [])
+        self.file.write(encode_move(move))
+        self.file.flush()
+        self.moves_since_snapshot += 1
+
+    def snapshot(self, state: rules.BoardState, playtime: float):
+        """
+        Record the whole position, after which older records are no longer read on resume. Does nothing
+        before the first move of a new journal, the file still holds the previous game
+        :param state:
+        :param playtime:
+        :return:
+        """
+        if self.file is None:
+            return
+        earlier = self.hashes + [undo.hash for undo in state.history]
+        self._write_snapshot(state.to_fen(), playtime, earlier[max(len(earlier) - state.halfmove_clock, 0):])
+
+    def _write_snapshot(self, fen: str, playtime: float, hashes: typing.List[int]):
+        offset = self.file.tell()
+        fen = fen.encode('ascii')
+        self.file.write(RECORD.pack(SNAPSHOT) + SNAPSHOT_FIELDS.pack(playtime, len(fen)) + fen +
+                        RECORD.pack(len(hashes)) + b''.join(HASH.pack(value) for value in hashes))
+        self.file.flush()
+        # only point at the snapshot once it is completely written
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, offset))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+        self.moves_since_snapshot = 0
+
+    def snapshot_due(self) -> bool:
+        return self.moves_since_snapshot >= SNAPSHOT_INTERVAL
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def resume(filename: str) -> typing.Optional[Resumed]:
+    """
+    Rebuild the position from the latest snapshot and the moves after it, with the repetition
+    counts of the positions recorded in the snapshot
+    :param filename:
+    :return: None when there is no usable journal
+    """
+    try:
+        file = open(filename, 'rb')
+    except FileNotFoundError:
+        return None
+    with file:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, offset = HEADER.unpack(header)
+        if magic != MAGIC or offset < HEADER.size:
+            return None
+        file.seek(offset)
+        tag = file.read(RECORD.size)
+        fields = file.read(SNAPSHOT_FIELDS.size)
+        if len(tag) < RECORD.size or RECORD.unpack(tag)[0] != SNAPSHOT or len(fields) < SNAPSHOT_FIELDS.size:
+            return None
+        playtime, length = SNAPSHOT_FIELDS.unpack(fields)
+        state = rules.BoardState.from_fen(file.read(length).decode('ascii'))
+        count = file.read(RECORD.size)
+        if len(count) < RECORD.size:
+            return None
+        count = RECORD.unpack(count)[0]
+        packed = file.read(count * HASH.size)
+        if len(packed) < count * HASH.size:
+            return None
+        hashes = [HASH.unpack_from(packed, index * HASH.size)[0] for index in range(count)]
+        for value in hashes:
+            state.repetitions[value] = state.repetitions.get(value, 0) + 1
+        end = offset + RECORD.size + SNAPSHOT_FIELDS.size + length + RECORD.size + len(packed)
+        tail = file.read()
+    for index in range(0, len(tail) - 1, RECORD.size):
+        value = RECORD.unpack_from(tail, index)[0]
+        if value & 0x8000:
+            break  # only a torn snapshot can follow the latest one
+        move = decode_move(value)
+        if not state.is_legal(move.from_sq, move.to_sq):
+            break
+        state.make_move(move.from_sq, move.to_sq, move.promotion or rules.QUEEN)
+        end += RECORD.size
+    return Resumed(state, playtime, end, hashes)
@@ -1,17 +1,35 @@
 #!/usr/bin/env python3
 """
-fully-functional 2 player chess
+fully-functional 2 player chess, with optional computer opponents
 """
-import pickle
+import argparse
+import concurrent.futures
 import json
+import logging
 import typing
 from enum import IntEnum
 
 import pygame
 
+import analysis
+import book
+import engine
+import journal
+import metrics
+import pgn
+import rules
+import server
+import tablebase
+
 from pygame.locals import (
     K_q,
     K_r,
+    K_u,
+    K_a,
+    K_e,
+    K_f,
+    K_b,
+    K_m,
     K_1,
     K_2,
     K_3,
@@ -20,19 +38,28 @@ from pygame.locals import (
     KEYDOWN,
     MOUSEBUTTONDOWN,
     QUIT,
+    USEREVENT,
 )
 
+logger = logging.getLogger(__name__)
+
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 FONT_SIZE = 20
+HIGHLIGHT_COLOR = (255, 215, 0, 110)
+TARGET_COLOR = (40, 40, 40, 90)
+JOURNAL_FILENAME = 'game.journal'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+WAKEUP_EVENT = USEREVENT + 1  # timer event that runs the event-driven loop while analysis is pending
 
 
 class Player:
-    def __init__(self, color: str, y_direction: int):
+    def __init__(self, color: str, y_direction: int, computer: engine.ParallelEngine = None):
         self.color = color
+        self.side = rules.COLOR_NAMES.index(color)
         self.y_direction = y_direction
         self.pieces: typing.List[Piece] = []
-        self.en_passant_pawn: Piece = None
+        self.engine = computer  # moves are searched instead of clicked when set
 
 
 class Board:
@@ -45,26 +72,38 @@ class Board:
         self.rect.top = (height - self.rect.height) / 2
         self.max_rows = 8
         self.max_cols = 8
+        # every square of a color shares one surface
+        self.square_surfaces = []
+        for color_config in (self.config.get('Dark'), self.config.get('Light')):
+            surface = pygame.Surface((self.position_size, self.position_size))
+            surface.fill((color_config.get('R'), color_config.get('G'), color_config.get('B')))
+            self.square_surfaces.append(surface)
         self.positions = [
             [Position(x, y, self) for y in range(self.max_rows)] for x in range(self.max_cols)
         ]
 
+    def position_at(self, pos: tuple) -> typing.Optional['Position']:
+        """
+        Square under a screen point, worked out from the board rect rather than testing every square
+        :param pos: screen coordinates
+        :return: None off the board
+        """
+        if not self.rect.collidepoint(*pos):
+            return None
+        x = (pos[0] - self.rect.left) // self.position_size
+        y = (self.rect.bottom - 1 - pos[1]) // self.position_size  # rank 1 is at the bottom
+        return self.positions[x][y]
+
 
 class Position(pygame.sprite.Sprite):
     def __init__(self, x: int, y: int, board: Board):
         super().__init__()
         self.x = x
         self.y = y
+        self.square = rules.square(x, y)
         self.board: Board = board
         self.piece: Piece = None
-        self.previous_piece: Piece = None
-        self.surface = pygame.Surface((board.position_size, board.position_size))
-        dark_config = board.config.get('Dark')
-        light_config = board.config.get('Light')
-        if (self.x % 2 == 0 and self.y % 2 == 0) or (self.x % 2 == 1 and self.y % 2 == 1):
-            self.surface.fill((dark_config.get('R'), dark_config.get('G'), dark_config.get('B')))
-        else:
-            self.surface.fill((light_config.get('R'), light_config.get('G'), light_config.get('B')))
+        self.surface = board.square_surfaces[0 if (self.x + self.y) % 2 == 0 else 1]
         self.rect: pygame.Rect = self.surface.get_rect()
         self.rect.left = board.rect.left + (self.x * self.surface.get_width())
         self.rect.bottom = board.rect.bottom - (self.y * self.surface.get_height())
@@ -73,7 +112,7 @@ class Position(pygame.sprite.Sprite):
         return f'<BoardPosition: {self.x}, {self.y}>'
 
     def __str__(self):
-        return f'{chr(self.x + 97)}{self.y + 1}'
+        return rules.square_name(self.square)
 
     def update(self):
         """
@@ -86,287 +125,92 @@ class Position(pygame.sprite.Sprite):
 
 
 class Piece(pygame.sprite.Sprite):
-    def __init__(self, player: Player, icon_config):
+    """
+    Sprite drawing one piece of the rules.BoardState; all movement rules live in rules.py
+    """
+    def __init__(self, player: Player, code: int, surface: pygame.Surface):
         super().__init__()
-        self.name = self.__class__.__name__
+        self.code = code
+        self.name = rules.PIECE_NAMES[rules.piece_kind(code)]
         self.surface: pygame.Surface = None
         self.image: pygame.image = None
         self.rect: pygame.Rect = None
         self.position: Position = None
-        self.previous_position: Position = None
-        # self.initial_position: Position = None
-        self.dirty = False  # has moved
         self.player: Player = player
-        player.pieces.append(self)
-        self.set_image(icon_config.get(self.player.color).get(self.name))
+        self.set_image(surface)
 
     def __repr__(self):
-        return f'<{self.__class__.__name__} @ {self.position.__repr__()}>'
+        return f'<{self.name} @ {self.position.__repr__()}>'
 
     def __str__(self):
-        return f'{self.__class__.__name__} @ {self.position}'
+        return f'{self.name} @ {self.position}'
 
-    def set_image(self, filename: str):
-        self.image = pygame.image.load(filename).convert_alpha()
-        self.surface = self.image
-        self.rect = self.image.get_rect()
+    def set_image(self, surface: pygame.Surface):
+        """
+        :param surface: shared between all pieces of the same code, never draw onto it
+        :return:
+        """
+        self.image = surface
+        self.surface = surface
+        self.rect = surface.get_rect()
 
     def set_position(self, position: Position):
-        self.previous_position = self.position
-        if self.position is not None:
-            # unset old position's piece
-            self.position.piece = None
+        if self.position is not None and self.position.piece is self:
+            self.position.clear_piece()
         self.position = position
-        # reset position's piece to self
-        position.previous_piece = position.piece
         position.piece = self
-        if position.previous_piece is not None:
-            position.previous_piece.player.pieces.remove(position.previous_piece)
         self.rect.left = position.rect.left
         self.rect.top = position.rect.top
 
-    def restore_position(self):
-        self.position.piece = self.position.previous_piece
-        if self.position.previous_piece is not None:
-            self.position.piece.player.pieces.append(self.position.piece)
-        self.position = self.previous_position
-        self.previous_position.piece = self
-        self.rect.left = self.position.rect.left
-        self.rect.top = self.position.rect.top
-
-    def can_move(self, position: Position) -> bool:
-        raise NotImplementedError('Child class must define a movement')
-
-    def _same_position(self, position: Position) -> bool:
-        if position == self.position:
-            print('Can\'t move to same position')
-            return True
-        return False
-
-    def _own_piece_interfering(self, position: Position) -> bool:
-        if position.piece is not None and position.piece.player == self.player:
-            print(f'Own {position.piece.name} in the way at destination')
-            return True
-        return False
-
-    def _straight_clear(self, position: Position) -> bool:
-        board = position.board
-        if position.x == self.position.x and position.y != self.position.y:
-            for y in range(min(position.y, self.position.y), max(position.y, self.position.y), 1):
-                if y == self.position.y or y == position.y:
-                    continue
-                if board.positions[position.x][y].piece is not None:
-                    print(f'{board.positions[position.x][y]} has piece {board.positions[position.x][y].piece.name}')
-                    return False
-            return True
-        if position.x != self.position.x and position.y == self.position.y:
-            for x in range(min(position.x, self.position.x), max(position.x, self.position.x), 1):
-                if x == self.position.x or x == position.x:
-                    continue
-                if board.positions[x][position.y].piece is not None:
-                    print(f'{board.positions[x][position.y]} has piece {board.positions[x][position.y].piece.name}')
-                    return False
-            return True
-
-    def _diagonal_clear(self, position: Position) -> bool:
-        board = position.board
-        # print(f'start position: {self.position.x},{self.position.y}, end position: {position.x},{position.y}')
-        x_dif = position.x - self.position.x
-        y_dif = position.y - self.position.y
-        if abs(x_dif) == abs(y_dif):
-            for dif in range(1, abs(x_dif), 1):
-                x = self.position.x + (dif % x_dif) if x_dif > 0 else self.position.x - (dif % abs(x_dif))
-                y = self.position.y + (dif % y_dif) if y_dif > 0 else self.position.y - (dif % abs(y_dif))
-                if board.positions[x][y].piece is not None:
-                    print(
-                        f'{board.positions[x][y]} has piece {board.positions[x][y].piece.name}')
-                    return False
-            return True
-
-
-class Pawn(Piece):
-    def can_move(self, position: Position) -> bool:
-        # same position
-        if self._same_position(position):
-            return False
-        # own piece in the way
-        elif self._own_piece_interfering(position):
-            return False
-        # standard forward move
-        elif position.x == self.position.x and \
-            position.y == (self.position.y + self.player.y_direction) and \
-            position.piece is None:
-            return True
-        # double-move from starting position
-        elif position.x == self.position.x and \
-            position.y == (self.position.y + (self.player.y_direction * 2)) and \
-            not self.dirty and \
-            position.piece is None:
-            self.player.en_passant_pawn = self  # making a move which allows en passant capture on opponent's turn
-            return True
-        # attack move into a position occupied by enemy
-        elif (position.x == (self.position.x + 1) or position.x == (self.position.x - 1)) and \
-            position.y == (self.position.y + self.player.y_direction):
-            if position.piece is not None and position.piece.player != self.player:
-                return True
-            elif position.board.positions[position.x][position.y + (self.player.y_direction * -1)].piece is not None and \
-                    position.board.positions[position.x][position.y + (self.player.y_direction * -1)].piece.player != self.player and \
-                    position.board.positions[position.x][position.y + (self.player.y_direction * -1)].piece.player.en_passant_pawn == position.board.positions[position.x][position.y + (self.player.y_direction * -1)].piece:
-                # en passant check
-                # move en passant pawn back to target position so it will be properly killed by _act logic
-                position.board.positions[position.x][position.y + (self.player.y_direction * -1)].piece.set_position(position)
-                print('En Passant!')
-                return True
-        return False
-
-    def promotion_check(self) -> bool:
-        if (self.player.y_direction < 0 and self.position.y == 0) or (self.player.y_direction > 0 and self.position.y == (self.position.board.max_rows - 1)):
-            return True
-        return False
-
-
-class Rook(Piece):
-    def can_move(self, position: Position) -> bool:
-        # same position
-        if self._same_position(position):
-            return False
-        # own piece in the way
-        elif self._own_piece_interfering(position):
-            return False
-        elif self._straight_clear(position):
-            return True
-        return False
-
-
-class Bishop(Piece):
-    def can_move(self, position: Position) -> bool:
-        # same position
-        if self._same_position(position):
-            return False
-        # own piece in the way
-        elif self._own_piece_interfering(position):
-            return False
-        elif self._diagonal_clear(position):
-            return True
-        return False
-
-
-class Knight(Piece):
-    def can_move(self, position: Position) -> bool:
-        # same position
-        if self._same_position(position):
-            return False
-        # own piece in the way
-        elif self._own_piece_interfering(position):
-            return False
-        elif (abs(position.x - self.position.x) == 1 and abs(position.y - self.position.y) == 2) or (
-            abs(position.x - self.position.x) == 2 and abs(position.y - self.position.y) == 1):
-            return True
-        return False
-
-
-class Queen(Piece):
-    def can_move(self, position: Position) -> bool:
-        # same position
-        if self._same_position(position):
-            return False
-        # own piece in the way
-        elif self._own_piece_interfering(position):
-            return False
-        elif self._straight_clear(position) or self._diagonal_clear(position):
-            return True
-        return False
-
-
-class King(Piece):
-    def can_move(self, position: Position) -> bool:
-        board = position.board
-        # same position
-        if self._same_position(position):
-            return False
-        # own piece in the way
-        elif self._own_piece_interfering(position):
-            return False
-        elif abs(position.x - self.position.x) <= 1 and abs(position.y - self.position.y) <= 1:
-            self.set_position(position)
-            if not self.check_check():
-                self.restore_position()
-                return True
-            self.restore_position()
-        elif not self.dirty and position.y == self.position.y and abs(position.x - self.position.x) == 2:
-            if self.check_check():
-                print('Can\'t castle out of check')
-                return False
-            y = self.position.y
-            # determine if legal castle
-            if position.x > self.position.x:
-                # king-side castle
-                rook_position = board.positions[7][y]
-                if rook_position.piece is not None and rook_position.piece.name == 'Rook' and rook_position.piece.player == self.player and not rook_position.piece.dirty:
-                    rook = rook_position.piece
-                    if board.positions[self.position.x + 1][y].piece is None:
-                        self.set_position(board.positions[self.position.x + 1][y])
-                        if self.check_check():
-                            print(f'King would be in check passing through {self.position}')
-                            self.restore_position()
-                            return False
-                        self.restore_position()
-                        self.set_position(position)
-                        if self.check_check():
-                            print(f'King would be in check at {self.position}')
-                            self.restore_position()
-                            return False
-                        rook.dirty = True
-                        rook.set_position(board.positions[self.position.x - 1][y])
-                        # reset king to original position so standard movement can occur
-                        self.restore_position()
-                        return True
+
+class AssetCache:
+    """
+    Decodes every image file once and hands the same surface, scaled to the board's square size, to
+    every piece of a kind. An icons.json entry is either an image file or a cell of a sprite sheet:
+    {"Sheet": "icons/chess_pieces_white.png", "Cell": 0, "Cells": 6} for the first of six equal columns
+    """
+    def __init__(self, icon_config: dict, size: int):
+        self.icon_config = icon_config
+        self.size = size
+        self.images: typing.Dict[str, pygame.Surface] = {}  # filename -> decoded image
+        self.pieces: typing.Dict[int, pygame.Surface] = {}  # piece code -> scaled icon
+
+    def image(self, filename: str) -> pygame.Surface:
+        image = self.images.get(filename)
+        if image is None:
+            image = self.images[filename] = pygame.image.load(filename).convert_alpha()
+        return image
+
+    def piece(self, code: int) -> pygame.Surface:
+        surface = self.pieces.get(code)
+        if surface is None:
+            entry = self.icon_config.get(rules.COLOR_NAMES[rules.piece_color(code)]).get(
+                rules.PIECE_NAMES[rules.piece_kind(code)])
+            if isinstance(entry, dict):
+                sheet = self.image(entry['Sheet'])
+                width = sheet.get_width() // entry['Cells']
+                image = sheet.subsurface((width * entry['Cell'], 0, width, sheet.get_height()))
             else:
-                # queen-side castle
-                rook_position = board.positions[0][y]
-                if rook_position.piece is not None and rook_position.piece.name == 'Rook' and rook_position.piece.player == self.player and not rook_position.piece.dirty:
-                    rook = rook_position.piece
-                    if board.positions[self.position.x - 1][y].piece is None and board.positions[self.position.x - 2][
-                        y].piece is None and board.positions[self.position.x - 3][y].piece is None:
-                        self.set_position(board.positions[self.position.x - 1][y])
-                        if self.check_check():
-                            print(f'King would be in check passing through {self.position}')
-                            self.restore_position()
-                            return False
-                        self.restore_position()
-                        self.set_position(position)
-                        if self.check_check():
-                            print(f'King would be in check at {self.position}')
-                            self.restore_position()
-                            return False
-                        rook.dirty = True
-                        rook.set_position(board.positions[self.position.x + 1][y])
-                        self.restore_position()
-                        return True
-        return False
-
-    def check_check(self):
-        other_player = game.inactive_player
-        for piece in other_player.pieces:
-            if piece.can_move(self.position):
-                print(f'{other_player.color} {piece.name} at {piece.position} has {self.player.color} King in check')
-                return True
-        return False
-
-    def checkmate_check(self):
-        board = self.position.board
-        print('Checkmate checking')
-        for piece in self.player.pieces:
-            for col in board.positions:
-                for position in col:
-                    if piece.can_move(position):
-                        piece.set_position(position)
-                        if not self.check_check():
-                            print(f'{piece} can break check')
-                            piece.restore_position()
-                            return False
-                        piece.restore_position()
-        return True
+                image = self.image(entry)
+            surface = self.pieces[code] = self._fit(image)
+        return surface
+
+    def _fit(self, image: pygame.Surface) -> pygame.Surface:
+        """
+        Scale image to fit a square, keeping its aspect ratio and centering it
+        :param image:
+        :return:
+        """
+        width, height = image.get_size()
+        if width == height == self.size:
+            return image
+        scale = self.size / max(width, height)
+        scaled_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        scaled = pygame.transform.smoothscale(image, scaled_size)
+        surface = pygame.Surface((self.size, self.size), pygame.SRCALPHA).convert_alpha()
+        surface.fill((0, 0, 0, 0))
+        surface.blit(scaled, scaled.get_rect(center=(self.size // 2, self.size // 2)))
+        return surface
 
 
 # def get_center(parent_surface: pygame.Surface, child_surface: pygame.Surface):
@@ -381,243 +225,686 @@ class State(IntEnum):
 
 
 class GameSession:
-    def __init__(self):
-        self.playtime = 0.0
+    def __init__(self, board_state: rules.BoardState = None, playtime: float = 0.0, journal_end: int = None,
+                 journal_hashes: typing.List[int] = ()):
+        self.board_state = board_state
+        self.playtime = playtime
+        self.journal_end = journal_end
+        self.journal_hashes = journal_hashes
         self.state = State.PIECE_SELECT
         self.selected_piece = None
 
 
 class Game:
-    def __init__(self, width: int, height: int, fps: int = 20):
+    def __init__(self, width: int, height: int, fps: int = 20, computer_colors: typing.Sequence[str] = (),
+                 movetime: float = 1.0, max_nodes: int = None, workers: int = 1, start_fen: str = None,
+                 resume: bool = False, book_filename: str = None,
+                 tablebase_directory: str = tablebase.DEFAULT_DIRECTORY, icon_filename: str = 'icons.json',
+                 event_driven: bool = False, remote: server.RemoteGame = None):
         """
         :param width:
         :param height:
         :param fps:
+        :param computer_colors: colors played by the engine
+        :param movetime: engine seconds per move
+        :param max_nodes: engine node budget per move
+        :param workers: engine search processes
+        :param start_fen: position to start from instead of the layout file
+        :param resume: continue the game saved in the journal file
+        :param book_filename: opening book for the computer players and the book hint
+        :param tablebase_directory: endgame tables for the computer players and the check text line
+        :param icon_filename: piece image config
+        :param event_driven: block until input instead of polling at fps, for idle displays
+        :param remote: game on a server.py server to play, starting from its position
         """
         pygame.init()
         pygame.display.set_caption("Press ESC to quit")
         self.width = width
         self.height = height
-        self.screen = pygame.display.set_mode((self.width, self.height), pygame.DOUBLEBUF)
+        # no DOUBLEBUF: _draw pushes only the rects that changed, which a flipped double buffer would lose
+        self.screen = pygame.display.set_mode((self.width, self.height))
         self.screen.fill((255, 0, 255))
         self.background = pygame.Surface(self.screen.get_size()).convert()
         self.background.fill((255, 255, 255))
         self.screen.blit(self.background, (0, 0))
         self.clock = pygame.time.Clock()
         self.fps = fps
+        self.event_driven = event_driven
+        self.wakeup_interval = 0  # milliseconds between WAKEUP_EVENTs, 0 when stopped
+        self.remote = remote
+        self.applying_remote = False  # set while playing a move the server sent, so it isn't sent back
+        self.remote_stale = False  # the server refused a change, reload its position on the next poll
         self.font = pygame.font.SysFont('mono', FONT_SIZE, bold=True)
+        self.drawn_squares: typing.List[tuple] = None  # (piece code, selected, target) last drawn per square, None to redraw all
+        self.drawn_text: typing.Dict[int, tuple] = {}  # line -> (text, position, color, surface, rect) last drawn
         self.check_text = ''
+        self.game_over = False
+        self.analysis: analysis.Analysis = None
+        self.analysis_text = ''
+        self.book = book.OpeningBook(book_filename) if book_filename else None
+        self.book_hint = (None, '')  # (position hash, text) so the hint disappears once the position changes
+        self.tablebases = tablebase.Tablebases(tablebase_directory)
         self.all_sprites = pygame.sprite.Group()
         self.game_pieces = pygame.sprite.Group()
-        self.players = [Player('White', y_direction=1), Player('Black', y_direction=-1)]
+        self.players = [
+            Player(color, y_direction,
+                   self._create_engine(movetime, max_nodes, workers, tablebase_directory)
+                   if color in computer_colors else None)
+            for color, y_direction in (('White', 1), ('Black', -1))
+        ]
+        # engine searches wait in this thread so the event loop keeps drawing and taking input meanwhile
+        self.search_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1) if computer_colors else None
+        self.search: typing.Optional[concurrent.futures.Future] = None
+        self.search_key = None  # (hash, moves played) of the position being searched
         self.board = Board(width, height)
         for position in self.board.positions:
             self.all_sprites.add(position)
+        self.highlight = pygame.Surface((self.board.position_size, self.board.position_size), pygame.SRCALPHA)
+        self.highlight.fill(HIGHLIGHT_COLOR)
+        self.target_marker = pygame.Surface((self.board.position_size, self.board.position_size), pygame.SRCALPHA)
+        size = self.board.position_size
+        pygame.draw.circle(self.target_marker, TARGET_COLOR, (size // 2, size // 2), size // 6)
         self.game_session = None
         self.active_player = None
         self.inactive_player = None
         self.state = None
         self.selected_piece = None
-        self.icon_config = self._load_icons()
+        self.legal_targets: typing.Set[int] = set()  # squares the selected piece can legally move to
+        self.promotion_square = None
+        self.board_state: rules.BoardState = None
+        self.icon_config = self._load_icons(icon_filename)
+        self.assets = AssetCache(self.icon_config, self.board.position_size)
         self.layout_config = self._load_layout()
+        self.start_fen = start_fen
+        self.journal: journal.Journal = None  # None for a server game, which mustn't replace the local saved one
         self.pieces = []
-        self._reset()
-
-    def _reset(self):
-        self.game_session: GameSession = GameSession()
-        self.active_player = self.players[0]
-        self.inactive_player = self.players[1]
+        self._reset(self._load() if resume else None)
+
+    def _reset(self, game_session: GameSession = None):
+        self.game_session: GameSession = game_session or GameSession()
+        if self.game_session.board_state is not None:
+            self.board_state = self.game_session.board_state
+        elif self.remote is not None:
+            self.board_state = rules.BoardState.from_fen(self.remote.fen)
+        elif self.start_fen:
+            self.board_state = rules.BoardState.from_fen(self.start_fen)
+        else:
+            self.board_state = rules.BoardState.from_layout(self.layout_config)
+        self.active_player = self.players[self.board_state.side]
+        self.inactive_player = self.players[self.board_state.side ^ 1]
         self.state = self.game_session.state
         self.selected_piece = self.game_session.selected_piece
-        self._remove_pieces()
-        self._load_pieces()
+        self.legal_targets = set()
+        self.promotion_square = None
+        if self.journal is not None:
+            self.journal.close()
+        if self.remote is None:
+            self.journal = journal.Journal(JOURNAL_FILENAME, self.board_state, self.game_session.playtime,
+                                           self.game_session.journal_end, self.game_session.journal_hashes)
+        self.game_session.board_state = None
+        self._sync_pieces()
+        self._update_check_text()
+        self._restart_analysis()
         self._draw()
 
+    @staticmethod
+    def _create_engine(movetime: float, max_nodes: int, workers: int, tablebase_directory: str) -> engine.ParallelEngine:
+        # even a single worker searches in its own process, so the search never holds the pygame loop's GIL;
+        # worker processes can't share the open tables, each opens the directory itself
+        return engine.ParallelEngine(workers, movetime, max_nodes, tablebase_directory=tablebase_directory)
+
     def _next_player(self):
         old_active = self.active_player
         self.active_player = self.inactive_player
         self.inactive_player = old_active
 
     @staticmethod
-    def _load_icons():
-        icon_filename = 'icons.json'
+    def _load_icons(icon_filename: str = 'icons.json'):
         with open(icon_filename) as icon_config_file:
             icon_config = json.load(icon_config_file)
         return icon_config
 
     @staticmethod
     def _load_layout():
-        layout_filename = 'piece_layout.json'
-        with open(layout_filename) as layout_config_file:
-            layout_config = json.load(layout_config_file)
-        return layout_config
+        return rules.load_layout()
 
-    def _load_piece(self, piece_class, player: Player, position: Position):
-        piece = piece_class(player, self.icon_config)
+    def _load_piece(self, code: int, position: Position, spares: dict = None):
+        """
+        Place a sprite for piece code at position, reusing a spare sprite of the same code if there is one
+        :param code:
+        :param position:
+        :param spares:
+        :return:
+        """
+        if spares and spares.get(code):
+            piece = spares[code].pop()
+        else:
+            piece = Piece(self.players[rules.piece_color(code)], code, self.assets.piece(code))
         piece.set_position(position)
+        piece.player.pieces.append(piece)
         self.pieces.append(piece)
         self.game_pieces.add(piece)
         self.all_sprites.add(piece)
 
-    def _load_pieces(self):
-        piece_types = [King, Queen, Rook, Bishop, Knight, Pawn]
-        for player in reversed(self.players):
-            for piece_type in piece_types:
-                positions = self.layout_config.get(player.color).get(piece_type.__name__)
-                for position in positions:
-                    self._load_piece(piece_type, player, self.board.positions[position.get('x')][position.get('y')])
+    def _sync_pieces(self):
+        """
+        Bring the piece sprites in line with board_state, moving existing sprites where possible
+        :return:
+        """
+        squares = self.board_state.squares
+        spares = {}
+        for piece in self.pieces.copy():
+            if squares[piece.position.square] != piece.code:
+                self._remove_piece(piece)
+                spares.setdefault(piece.code, []).append(piece)
+        for col in self.board.positions:
+            for position in col:
+                code = squares[position.square]
+                if code and position.piece is None:
+                    self._load_piece(code, position, spares)
 
     def _remove_piece(self, piece: Piece):
         piece.player.pieces.remove(piece)
         self.pieces.remove(piece)
         position = piece.position
-        position.piece = None
+        if position.piece is piece:
+            position.clear_piece()
         piece.kill()
         piece.position = None
-        # self.game_pieces.remove(piece)
-        # self.all_sprites.remove(piece)
-
-    def _remove_pieces(self):
-        pieces = self.pieces.copy() # create a temp copy of self.pieces to avoid removing from list while iterating over it
-        for piece in pieces:
-            self._remove_piece(piece)
 
     def run(self):
         """
-        Main event loop
+        Main event loop. Polls at fps, or with event_driven set, sleeps until there is input and only
+        wakes on a timer while something can change without it, such as background analysis
         :return:
         """
         running = True
+        last_ticks = pygame.time.get_ticks()
         while running:
-            milliseconds = self.clock.tick(self.fps)
-            self.game_session.playtime += milliseconds / 1000.0
-
-            for event in pygame.event.get():
+            if self.event_driven:
+                self._schedule_wakeup()
+                events = [pygame.event.wait()] + pygame.event.get()
+            else:
+                self.clock.tick(self.fps)
+                events = pygame.event.get()
+            # time measured between passes rather than per frame, so sleeping for input still counts
+            ticks = pygame.time.get_ticks()
+            self.game_session.playtime += (ticks - last_ticks) / 1000.0
+            last_ticks = ticks
+
+            for event in events:
                 if event.type == QUIT or (event.type == KEYDOWN and event.key in [K_ESCAPE, K_q]):
                     running = False
                 elif event.type == MOUSEBUTTONDOWN:
                     self._act(event.pos, event.button)
                 elif event.type == KEYDOWN and event.key == K_r:
-                    self._reset()
+                    self._new_game()
+                elif event.type == KEYDOWN and event.key == K_u:
+                    self._takeback()
+                elif event.type == KEYDOWN and event.key == K_a:
+                    self._toggle_analysis()
+                elif event.type == KEYDOWN and event.key == K_e:
+                    self._export_pgn()
+                elif event.type == KEYDOWN and event.key == K_b:
+                    self._show_book_moves()
+                elif event.type == KEYDOWN and event.key == K_f:
+                    logger.info('FEN: %s', self.board_state.to_fen())
+                elif event.type == KEYDOWN and event.key == K_m:
+                    metrics.dump(logger)
                 elif self.state == State.PAWN_PROMOTION and event.type == KEYDOWN and event.key in (K_1, K_2, K_3, K_4):
                     self._pawn_promote(event.key)
 
+            if self.remote is not None:
+                self._poll_remote()
+
+            if self.analysis is not None:
+                update = self.analysis.poll()
+                if update is not None:
+                    self.analysis_text = f'Analysis: {update.text}'
+                    self._draw()
+
+            if self._computer_to_move():
+                self._computer_move()
+
+        pygame.time.set_timer(WAKEUP_EVENT, 0)
+        self._save()
+        if self.journal is not None:
+            self.journal.close()
+        if self.book is not None:
+            self.book.close()
+        if self.remote is not None:
+            self.remote.close()
+        self.tablebases.close()
+        if self.analysis is not None:
+            self.analysis.close()
+        if self.search_thread is not None:
+            self.search_thread.shutdown()
+        for player in self.players:
+            if player.engine is not None:
+                player.engine.close()
         pygame.quit()
 
+    def _computer_to_move(self) -> bool:
+        return self.active_player.engine is not None and self.state == State.PIECE_SELECT and not self.game_over
+
+    def _schedule_wakeup(self):
+        """
+        Keep the wakeup timer running only while the loop has work that no input event will trigger
+        :return:
+        """
+        if self._computer_to_move() and self.search is None:
+            # a move to search, so don't sleep: the wait returns at once and the queue is only drained
+            pygame.event.post(pygame.event.Event(WAKEUP_EVENT))
+            interval = 0
+        elif self._computer_to_move() or self.analysis is not None or self.remote is not None:
+            interval = max(1, 1000 // self.fps)
+        else:
+            interval = 0
+        if interval != self.wakeup_interval:
+            pygame.time.set_timer(WAKEUP_EVENT, interval)
+            self.wakeup_interval = interval
+
     def _act(self, pos: tuple, button: int):
-        if button == 1 and self.board.rect.collidepoint(*pos):
+        if self.active_player.engine is not None:
+            return
+        position = self.board.position_at(pos)
+        if button == 1 and self.game_over:
+            logger.info('The game is over, press R to reset')
+        elif button == 1 and position is not None:
             player = self.active_player
             if self.state == State.PIECE_SELECT:
-                for piece in player.pieces:
-                    if piece.rect.collidepoint(*pos):
-                        print(f'Selected {player.color} {piece}')
-                        self.state = State.MOVE
-                        self.selected_piece = piece
-                        self._draw()
+                piece = position.piece
+                if piece is not None and piece.player is player:
+                    logger.info('Selected %s %s', player.color, piece)
+                    self.state = State.MOVE
+                    self.selected_piece = piece
+                    self.legal_targets = {move.to_sq for move in self.board_state.legal_moves()
+                                          if move.from_sq == position.square}
+                    self._draw()
             elif self.state == State.MOVE:
-                for row in self.board.positions:
-                    for position in row:
-                        if position.rect.collidepoint(*pos):
-                            if self.selected_piece.can_move(position):
-                                self.selected_piece.set_position(position)
-                                for piece in self.active_player.pieces:
-                                    if piece.name == 'King':
-                                        # print('Check checking')
-                                        if piece.check_check():
-                                            print('Move not allowed because player would be in check')
-                                            self.selected_piece.restore_position()
-                                            return
-                                self.selected_piece.restore_position()
-                                print(f'Moving {player.color} {self.selected_piece.name} to {position}')
-                                if position.piece is not None:
-                                    print(f'Defeated {position.piece.player.color} {position.piece}')
-                                    # position.piece.player.pieces.remove(position.piece)
-                                    # position.piece.kill()
-                                    self._remove_piece(position.piece)
-                                self.selected_piece.set_position(position)
-                                self.selected_piece.dirty = True
-                                if self.selected_piece.name == 'Pawn' and self.selected_piece.promotion_check():
-                                    self.state = State.PAWN_PROMOTION
-                                    self._draw_text(f'Pawn promotion: 1. Queen, 2. Knight, 3. Rook, 4. Bishop', (0, SCREEN_HEIGHT - FONT_SIZE), (0, 0, 0))
-                                else:
-                                    self._end_turn()
-                                self._draw()
-                            else:
-                                print(f'Movement to {position} not legal')
+                from_sq = self.selected_piece.position.square
+                if position.square not in self.legal_targets:
+                    # only an illegal click needs the reason worked out
+                    if not self.board_state.can_move(from_sq, position.square):
+                        logger.info('Movement to %s not legal', position)
+                    else:
+                        logger.info('Move not allowed because player would be in check')
+                elif self.board_state.is_promotion(from_sq, position.square):
+                    self.state = State.PAWN_PROMOTION
+                    self.promotion_square = position.square
+                    self._draw()
+                else:
+                    self._move(position.square)
         elif button == 3 and self.state == State.MOVE:
             self.state = State.PIECE_SELECT
             self.selected_piece = None
-            print('Canceled piece selection')
+            self.legal_targets = set()
+            logger.info('Canceled piece selection')
             self._draw()
 
+    def _move(self, to_sq: int, promotion: int = rules.QUEEN):
+        player = self.active_player
+        if self.analysis is not None:
+            self.analysis.stop()
+        description = self.board_state.describe_move(self.selected_piece.position.square, to_sq, promotion)
+        logger.info('Moving %s %s to %s', player.color, self.selected_piece.name, rules.square_name(to_sq))
+        if description.captured:
+            logger.info('Defeated %s %s @ %s', self.inactive_player.color,
+                        rules.PIECE_NAMES[rules.piece_kind(description.captured)], rules.square_name(description.captured_sq))
+        if description.rook_from is not None:
+            logger.info('Castling, Rook to %s', rules.square_name(description.rook_to))
+        self.board_state.make_move(*description.move)
+        self._sync_pieces()
+        self._end_turn()
+        self._draw()
+
     def _end_turn(self):
-        self.selected_piece = None
+        with metrics.Timer('end_turn'):
+            if self.journal is not None:
+                self.journal.append_move(self.board_state.history[-1].move)
+                if self.journal.snapshot_due():
+                    self._save()
+            if self.remote is not None and not self.applying_remote:
+                self._tell_remote(f'MOVE {self.board_state.history[-1].move}')
+            self.selected_piece = None
+            self.legal_targets = set()
+            self.promotion_square = None
+            self._next_player()
+            self._update_check_text()
+            self._restart_analysis()
+            self.state = State.PIECE_SELECT
+
+    def _toggle_analysis(self):
+        if self.analysis is None:
+            logger.info('Analysis on')
+            self.analysis = analysis.Analysis()
+            self._restart_analysis()
+        else:
+            logger.info('Analysis off')
+            self.analysis.close()
+            self.analysis = None
+            self.analysis_text = ''
+        self._draw()
+
+    def _restart_analysis(self):
+        if self.analysis is None:
+            return
+        self.analysis_text = 'Analysis: thinking...'
+        if self.game_over:
+            self.analysis.stop()
+            self.analysis_text = ''
+        else:
+            self.analysis.start(self.board_state)
+
+    def _takeback(self):
+        if not self.board_state.history:
+            logger.info('No moves to take back')
+            return
+        self._unmake_move()
+        if self.active_player.engine is not None and self.board_state.history:
+            # back to the human's turn rather than letting the computer replay its move
+            self._unmake_move()
+        self._after_takeback()
+
+    def _unmake_move(self):
+        move = self.board_state.unmake_move()
+        logger.info('Took back %s %s', rules.COLOR_NAMES[self.board_state.side], move)
         self._next_player()
-        self.active_player.en_passant_pawn = None
-        for piece in self.active_player.pieces:
-            if piece.name == 'King':
-                # print('Check checking')
-                in_check = piece.check_check()
-                if in_check:
-                    self.check_text = f'{self.active_player.color} in check!'
-                    in_checkmate = piece.checkmate_check()
-                    if in_checkmate:
-                        self.check_text = f'{self.active_player.color} CHECKMATE. Press R to reset'
-                else:
-                    self.check_text = ''
+        if self.remote is not None and not self.applying_remote:
+            self._tell_remote('UNDO')
+
+    def _after_takeback(self):
+        self.selected_piece = None
+        self.legal_targets = set()
+        self.promotion_square = None
+        self._save()  # the journal only records moves forward
+        self._sync_pieces()
+        self._update_check_text()
+        self._restart_analysis()
         self.state = State.PIECE_SELECT
+        self._draw()
+
+    def _new_game(self):
+        if self.remote is not None:
+            try:
+                self.remote.new_game(self.start_fen)
+                logger.info('Started game %d on the server', self.remote.id)
+            except server.ServerError as error:
+                logger.error('Server refused a new game: %s', error)
+                return
+        self._reset()
+
+    def _tell_remote(self, line: str):
+        try:
+            self.remote.request(line)
+        except server.ServerError as error:
+            # someone else changed the game first, the server's position wins
+            logger.error('Server refused %s: %s', line, error)
+            self.remote_stale = True
+
+    def _poll_remote(self):
+        """
+        Play the moves and takebacks other clients of the same server game made
+        :return:
+        """
+        lines = self.remote.poll()
+        if self.remote_stale:
+            self.remote_stale = False
+            self.remote.fen = self.remote.request('FEN')
+            self._reset()
+            return
+        for line in lines:
+            self.applying_remote = True
+            try:
+                if line.startswith('MOVED '):
+                    move = rules.parse_move(line.split()[1])
+                    logger.info('Server: %s', move)
+                    if not self.board_state.is_legal(move.from_sq, move.to_sq):
+                        self.remote_stale = True
+                        break
+                    self.selected_piece = self.board.positions[move.from_sq & 7][move.from_sq >> 3].piece
+                    self._move(move.to_sq, move.promotion or rules.QUEEN)
+                elif line == 'UNDONE' and self.board_state.history:
+                    self._unmake_move()
+                    self._after_takeback()
+            finally:
+                self.applying_remote = False
+
+    def _computer_move(self):
+        """
+        Play a book or tablebase move at once, otherwise start an engine search in the background and play its
+        move on a later pass of the event loop, once it has finished
+        :return:
+        """
+        key = (self.board_state.hash, len(self.board_state.history))
+        if self.search is not None and self.search_key != key:
+            self.search = None  # the position changed under it (reset, takeback, server), drop the result
+        if self.search is not None:
+            if not self.search.done():
+                return
+            result = self.search.result()
+            self.search = None
+            logger.info('%s computer: %s', self.active_player.color, result)
+            move = result.move
+        else:
+            move = self.book.choose(self.board_state) if self.book is not None else None
+            found = self.tablebases.best_move(self.board_state) if move is None and self.tablebases else None
+            if move is not None:
+                logger.info('%s computer: book move %s', self.active_player.color, move)
+            elif found is not None:
+                move, probe = found
+                logger.info('%s computer: tablebase move %s, %s', self.active_player.color, move, probe)
+            else:
+                self.search = self.search_thread.submit(self.active_player.engine.search, self.board_state.copy())
+                self.search_key = key
+                return
+        self.selected_piece = self.board.positions[move.from_sq & 7][move.from_sq >> 3].piece
+        self._move(move.to_sq, move.promotion or rules.QUEEN)
+
+    def _show_book_moves(self):
+        if self.book is None:
+            logger.warning('No opening book loaded, start with --book')
+            return
+        entries = self.book.entries(self.board_state)
+        total = sum(entry.weight for entry in entries) or 1
+        moves = ', '.join(f'{pgn.move_to_san(self.board_state, entry.move)} {entry.weight / total:.0%}'
+                          for entry in entries[:5])
+        text = f'Book: {moves}' if entries else 'Book: position not in book'
+        logger.info('%s', text)
+        self.book_hint = (self.board_state.hash, text)
+        self._draw()
+
+    def _update_check_text(self):
+        side = self.active_player.side
+        in_check = self.board_state.in_check(side)
+        self.game_over = True
+        if not self.board_state.has_legal_move(side):
+            if in_check:
+                self.check_text = f'{self.active_player.color} CHECKMATE. Press R to reset'
+            else:
+                self.check_text = 'STALEMATE. Press R to reset'
+        elif self.board_state.is_repetition():
+            self.check_text = 'DRAW by threefold repetition. Press R to reset'
+        elif self.board_state.is_fifty_move_draw():
+            self.check_text = 'DRAW by fifty-move rule. Press R to reset'
+        elif self.board_state.is_insufficient_material():
+            self.check_text = 'DRAW by insufficient material. Press R to reset'
+        else:
+            self.game_over = False
+            self.check_text = f'{self.active_player.color} in check!' if in_check else ''
+            probe = self.tablebases.probe(self.board_state) if self.tablebases else None
+            if probe is not None:
+                if probe.wdl:
+                    winner = self.active_player if probe.wdl > 0 else self.inactive_player
+                    tablebase_text = f'Tablebase: {winner.color} mates in {(probe.plies + 1) // 2}'
+                else:
+                    tablebase_text = 'Tablebase: draw'
+                self.check_text = f'{self.check_text} {tablebase_text}' if self.check_text else tablebase_text
+
+    def _export_pgn(self, filename: str = 'games.pgn'):
+        """
+        Append the game so far to a PGN file
+        :param filename:
+        :return:
+        """
+        start = self.board_state.copy()
+        while start.history:
+            start.unmake_move()
+        outcome = self.board_state.outcome()
+        headers = {
+            'Event': 'pygame chess',
+            'White': 'Computer' if self.players[rules.WHITE].engine else 'Human',
+            'Black': 'Computer' if self.players[rules.BLACK].engine else 'Human',
+            'Result': outcome[0] if outcome else '*',
+        }
+        if outcome:
+            headers['Termination'] = outcome[1]
+        moves = [undo.move for undo in self.board_state.history]
+        with open(filename, 'a') as file:
+            pgn.write_game(file, moves, headers, start)
+        logger.info('Exported %d moves to %s', len(moves), filename)
 
     def _pawn_promote(self, key):
-        position = self.selected_piece.position
-        self._remove_piece(self.selected_piece)
-        # generate new piece
         if key == K_1:
-            piece_type = Queen
+            kind = rules.QUEEN
         elif key == K_2:
-            piece_type = Knight
+            kind = rules.KNIGHT
         elif key == K_3:
-            piece_type = Rook
+            kind = rules.ROOK
         else:
-            piece_type = Bishop
-        self._load_piece(piece_type, self.active_player, position)
-        self._end_turn()
-        self._draw()
+            kind = rules.BISHOP
+        self._move(self.promotion_square, kind)
 
     def _draw(self):
-        for sprite in self.all_sprites:
-            self.screen.blit(sprite.surface, sprite.rect)
-
-        width, height = self._draw_text(f'Player turn: {self.active_player.color}', (0, 0), (0, 0, 0))
-        self._draw_text(f'Piece selected: {self.selected_piece.name if self.selected_piece else "None"}', (0, height),
-                        (0, 0, 0))
-        self._draw_text(self.check_text, (0, height * 2), (200, 0, 0))
-
-        pygame.display.flip()
-        self.screen.blit(self.background, (0, 0))
-
-    def _draw_text(self, text: str, position: tuple, color: tuple):
         """
-        Draw text in window
-        :param text:
+        Repaint only the squares whose piece or highlight changed and the text lines whose string changed,
+        then push just those rects to the display
+        :return:
+        """
+        if self.drawn_squares is None:
+            self.drawn_squares = [None] * 64
+            self.drawn_text = {}
+            dirty = [self.screen.get_rect()]
+        else:
+            dirty = []
+
+        for line, (text, position, color) in enumerate(self._text_lines()):
+            drawn = self.drawn_text.get(line)
+            if drawn is not None and drawn[:3] == (text, position, color):
+                continue
+            if drawn is not None:
+                dirty.append(drawn[4])
+                del self.drawn_text[line]
+            if text:
+                surface = self.font.render(text, True, color)
+                rect = surface.get_rect(topleft=position)
+                self.drawn_text[line] = (text, position, color, surface, rect)
+                dirty.append(rect)
+
+        for column in self.board.positions:
+            for position in column:
+                piece = position.piece
+                key = (piece.code if piece is not None else rules.EMPTY,
+                       piece is not None and piece is self.selected_piece,
+                       position.square in self.legal_targets)
+                if key != self.drawn_squares[position.square]:
+                    self.drawn_squares[position.square] = key
+                    dirty.append(position.rect)
+
+        for rect in dirty:
+            self._repaint(rect)
+        pygame.display.update(dirty)
+
+    def _repaint(self, rect: pygame.Rect):
+        """
+        Paint background, squares and text, in that order, clipped to rect
+        :param rect:
         :return:
         """
-        font_width, font_height = self.font.size(text)
-        surface = self.font.render(text, True, color)
-        self.screen.blit(surface, position)
-        return font_width, font_height
+        self.screen.set_clip(rect)
+        self.screen.blit(self.background, rect, rect)
+        if rect.colliderect(self.board.rect):
+            for column in self.board.positions:
+                for position in column:
+                    if position.rect.colliderect(rect):
+                        self.screen.blit(position.surface, position.rect)
+                        _, selected, target = self.drawn_squares[position.square]
+                        if selected:
+                            self.screen.blit(self.highlight, position.rect)
+                        if position.piece is not None:
+                            self.screen.blit(position.piece.surface, position.piece.rect)
+                        if target:
+                            self.screen.blit(self.target_marker, position.rect)
+        for line in sorted(self.drawn_text):
+            _, _, _, surface, text_rect = self.drawn_text[line]
+            if text_rect.colliderect(rect):
+                self.screen.blit(surface, text_rect)
+        self.screen.set_clip(None)
+
+    def _text_lines(self) -> typing.List[tuple]:
+        """
+        (text, position, color) of every line of text on screen, empty text for lines not shown
+        :return:
+        """
+        height = self.font.get_height()
+        book_hint = self.book_hint[1] if self.book_hint[0] == self.board_state.hash else ''
+        promotion = 'Pawn promotion: 1. Queen, 2. Knight, 3. Rook, 4. Bishop' if self.state == State.PAWN_PROMOTION else ''
+        return [
+            (f'Player turn: {self.active_player.color}', (0, 0), (0, 0, 0)),
+            (f'Piece selected: {self.selected_piece.name if self.selected_piece else "None"}', (0, height), (0, 0, 0)),
+            (self.check_text, (0, height * 2), (200, 0, 0)),
+            (self.analysis_text, (0, height * 3), (0, 0, 120)),
+            (book_hint, (0, height * 4), (0, 100, 0)),
+            (promotion, (0, SCREEN_HEIGHT - FONT_SIZE), (0, 0, 0)),
+        ]
 
-    def _load(self) -> GameSession:
-        try:
-            with open('data.dat', 'rb') as file:
-                return pickle.load(file)
-        except FileNotFoundError:
+    @staticmethod
+    def _load() -> GameSession:
+        resumed = journal.resume(JOURNAL_FILENAME)
+        if resumed is None:
+            logger.warning('No saved game in %s, starting a new one', JOURNAL_FILENAME)
             return GameSession()
+        logger.info('Resumed game from %s', JOURNAL_FILENAME)
+        return GameSession(resumed.state, resumed.playtime, resumed.end, resumed.hashes)
 
     def _save(self):
-        with open('data.dat', 'wb') as file:
-            pickle.dump(self.game_session, file)
+        if self.journal is not None:
+            self.journal.snapshot(self.board_state, self.game_session.playtime)
 
 
 if __name__ == '__main__':
-    game = Game(SCREEN_WIDTH, SCREEN_HEIGHT)
+    parser = argparse.ArgumentParser(description='pygame chess')
+    parser.add_argument('--computer', choices=['White', 'Black'], action='append', default=[],
+                        help='let the engine play a color, may be given twice')
+    parser.add_argument('--movetime', type=float, default=1.0, help='engine seconds per move (default 1)')
+    parser.add_argument('--nodes', type=int, help='engine node budget per move')
+    parser.add_argument('--workers', type=int, default=1, help='engine search processes (default 1)')
+    parser.add_argument('--fen', help='start from this position instead of piece_layout.json')
+    parser.add_argument('--resume', action='store_true', help=f'continue the game saved in {JOURNAL_FILENAME}')
+    parser.add_argument('--book', help='opening book built with book.py, used by the computer and the B hint')
+    parser.add_argument('--event-driven', action='store_true',
+                        help='sleep until input instead of polling at a fixed frame rate')
+    parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS, help='console log level (default INFO)')
+    parser.add_argument('--metrics', help='write rules and timing counters to this JSON file on exit')
+    parser.add_argument('--connect', metavar='HOST:PORT', help='play a game hosted by server.py')
+    parser.add_argument('--join', type=int, help='with --connect, join this game instead of starting one')
+    parser.add_argument('--icons', default='icons.json', help='piece image config (default icons.json)')
+    parser.add_argument('--tablebases', default=tablebase.DEFAULT_DIRECTORY,
+                        help=f'endgame tables built with tablebase.py (default {tablebase.DEFAULT_DIRECTORY})')
+    args = parser.parse_args()
+    if args.resume and args.connect:
+        parser.error('--resume continues a local game, it cannot be used with --connect')
+    logging.basicConfig(level=args.log_level, format='%(message)s')
+    remote = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+        remote = server.RemoteGame(host or server.DEFAULT_HOST, int(port), args.join, args.fen)
+        logger.info('Playing game %d on %s', remote.id, args.connect)
+    game = Game(SCREEN_WIDTH, SCREEN_HEIGHT, computer_colors=args.computer, movetime=args.movetime,
+                max_nodes=args.nodes, workers=args.workers, start_fen=args.fen, resume=args.resume,
+                book_filename=args.book, tablebase_directory=args.tablebases,
+                icon_filename=args.icons, event_driven=args.event_driven, remote=remote)
     game.run()
+    metrics.dump(logger, logging.DEBUG)
+    if args.metrics:
+        metrics.export(args.metrics)
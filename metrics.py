@@ -0,0 +1,80 @@
+"""
+always-on counters and timers
+
+Hot paths bump a plain dict entry, which costs far less than the work being counted, so the
+counts are kept whether or not anyone looks at them. Timers keep the count, total and slowest
+duration of a named operation. Every process has its own counters; engine and analysis worker
+processes are not included in the game's totals.
+"""
+import json
+import logging
+import time
+import typing
+
+counters: typing.Dict[str, int] = {}
+timings: typing.Dict[str, typing.List[float]] = {}  # name -> [count, total seconds, max seconds]
+
+
+def record(name: str, seconds: float):
+    timing = timings.get(name)
+    if timing is None:
+        timings[name] = [1, seconds, seconds]
+    else:
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+
+
+class Timer:
+    """
+    Context manager recording how long its block took under name
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+
+
+def snapshot() -> dict:
+    return {
+        'counters': dict(sorted(counters.items())),
+        'timings': {
+            name: {'count': int(timing[0]), 'total': timing[1], 'mean': timing[1] / timing[0], 'max': timing[2]}
+            for name, timing in sorted(timings.items())
+        },
+    }
+
+
+def reset():
+    # counters are zeroed rather than removed, modules bump their entries without checking they exist
+    for name in counters:
+        counters[name] = 0
+    timings.clear()
+
+
+def dump(logger: logging.Logger, level: int = logging.INFO):
+    """
+    Log every counter and timer, one per line
+    :param logger:
+    :param level:
+    :return:
+    """
+    if not logger.isEnabledFor(level):
+        return
+    for name, value in sorted(counters.items()):
+        logger.log(level, '%-24s %12d', name, value)
+    for name, (calls, total, longest) in sorted(timings.items()):
+        logger.log(level, '%-24s %12d calls, mean %.3fms, max %.3fms', name, calls, total / calls * 1000,
+                   longest * 1000)
+
+
+def export(filename: str):
+    with open(filename, 'w') as metrics_file:
+        json.dump(snapshot(), metrics_file, indent=2)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+perft move generator check and throughput benchmark
+
+Runs rules.perft against the standard reference positions (or a given FEN) and reports
+node counts, whether they match the published numbers, and nodes per second.
+"""
+import argparse
+import time
+
+import rules
+
+# (name, fen, node counts for depth 1, 2, 3, ...)
+REFERENCE_POSITIONS = [
+    ('start', rules.START_FEN, [20, 400, 8902, 197281, 4865609]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', [48, 2039, 97862, 4085603]),
+    ('position3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', [14, 191, 2812, 43238, 674624]),
+    ('position4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1', [6, 264, 9467, 422333]),
+    ('position5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', [44, 1486, 62379, 2103487]),
+    ('position6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10', [46, 2079, 89890, 3894594]),
+]
+
+
+def run_perft(name: str, fen: str, depth: int, expected: int = None, divide: bool = False) -> bool:
+    state = rules.BoardState.from_fen(fen)
+    start = time.perf_counter()
+    if divide:
+        nodes = 0
+        for move in state.legal_moves():
+            state.make_move(*move)
+            count = rules.perft(state, depth - 1)
+            state.unmake_move()
+            print(f'  {move}: {count}')
+            nodes += count
+    else:
+        nodes = rules.perft(state, depth)
+    elapsed = time.perf_counter() - start
+    nodes_per_second = nodes / elapsed if elapsed > 0 else 0.0
+    ok = expected is None or nodes == expected
+    status = '' if expected is None else (' ok' if ok else f' FAIL (expected {expected})')
+    print(f'{name} depth {depth}: {nodes} nodes in {elapsed:.3f}s, {nodes_per_second:,.0f} nodes/sec{status}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('depth', type=int, nargs='?', default=3, help='search depth (default 3)')
+    parser.add_argument('--fen', help='run a single position instead of the reference suite')
+    parser.add_argument('--divide', action='store_true', help='print node counts per root move')
+    args = parser.parse_args()
+
+    if args.fen:
+        run_perft('fen', args.fen, args.depth, divide=args.divide)
+        return
+    failures = 0
+    for name, fen, counts in REFERENCE_POSITIONS:
+        depth = min(args.depth, len(counts))
+        if not run_perft(name, fen, depth, counts[depth - 1], args.divide):
+            failures += 1
+    if failures:
+        raise SystemExit(f'{failures} reference position(s) failed')
+
+
+if __name__ == '__main__':
+    main()
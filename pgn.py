@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+streaming PGN reader and writer
+
+Games are read one at a time from a binary stream, so a database of any size is replayed
+with flat memory use. Every move is checked against the rules while it is replayed:
+    read_games(stream) -> PgnGame ... -> replay_games(games) -> ReplayedGame ...
+Commands:
+    replay games.pgn            validate every game and report games/sec
+    convert games.jsonl         turn selfplay.py output into PGN
+"""
+import argparse
+import json
+import re
+import sys
+import time
+import typing
+
+import rules
+
+SAN_PIECES = ' PNBRQK'
+HEADER_PATTERN = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+TOKEN_PATTERN = re.compile(r'\{[^}]*\}?|;[^\n]*|\$\d+|\(|\)|1-0|0-1|1/2-1/2|\*|\d+\.+|[^\s(){};$]+')
+SAN_PATTERN = re.compile(r'^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$')
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+SEVEN_TAG_ROSTER = (('Event', '?'), ('Site', '?'), ('Date', '????.??.??'), ('Round', '?'), ('White', '?'),
+                    ('Black', '?'), ('Result', '*'))
+LINE_LENGTH = 79
+
+
+class PgnError(ValueError):
+    pass
+
+
+class PgnGame(typing.NamedTuple):
+    headers: typing.Dict[str, str]
+    moves: typing.List[str]  # SAN, main line only
+    result: str
+    offset: int  # byte offset of the game's first line in the stream
+
+
+class ReplayedGame(typing.NamedTuple):
+    game: PgnGame
+    moves: typing.List[rules.Move]  # moves replayed before the first error, all of them if error is None
+    error: typing.Optional[str]
+    state: rules.BoardState  # position after the last replayed move
+
+
+def starting_state(headers: typing.Dict[str, str]) -> rules.BoardState:
+    fen = headers.get('FEN')
+    if not fen:
+        return rules.BoardState.from_fen(rules.START_FEN)
+    try:
+        return rules.BoardState.from_fen(fen)
+    except (ValueError, IndexError):
+        raise PgnError(f'Bad FEN header {fen!r}')
+
+
+def parse_san(state: rules.BoardState, san: str) -> rules.Move:
+    """
+    Find the legal move of the side to move that san describes
+    :param state:
+    :param san: e.g. e4, exd5, Nbd2, O-O, e8=Q+
+    :return:
+    """
+    text = san.rstrip('+#!?')
+    color = state.side
+    if text in ('O-O', 'O-O-O', '0-0', '0-0-0'):
+        king = state.king_square(color)
+        if king is not None:
+            to_sq = king + 2 if len(text) == 3 else king - 2
+            if state.is_legal(king, to_sq):
+                return rules.Move(king, to_sq)
+        raise PgnError(f'Illegal castle {san}')
+    match = SAN_PATTERN.match(text)
+    if not match:
+        raise PgnError(f'Unreadable move {san}')
+    piece, from_file, from_rank, to_name, promotion = match.groups()
+    to_sq = rules.square(ord(to_name[0]) - 97, int(to_name[1]) - 1)
+    kind = SAN_PIECES.index(piece) if piece else rules.PAWN
+    if kind == rules.PAWN and from_file is None:
+        from_file = to_name[0]
+    candidates = []
+    for from_sq in rules.iter_bits(state.bitboards[rules.piece_code(color, kind)]):
+        if from_file is not None and from_sq & 7 != ord(from_file) - 97:
+            continue
+        if from_rank is not None and from_sq >> 3 != int(from_rank) - 1:
+            continue
+        if state.is_legal(from_sq, to_sq):
+            candidates.append(from_sq)
+    if not candidates:
+        raise PgnError(f'Illegal move {san}')
+    if len(candidates) > 1:
+        raise PgnError(f'Ambiguous move {san}')
+    from_sq = candidates[0]
+    if state.is_promotion(from_sq, to_sq):
+        if promotion is None:
+            raise PgnError(f'Missing promotion piece in {san}')
+        return rules.Move(from_sq, to_sq, SAN_PIECES.index(promotion))
+    if promotion is not None:
+        raise PgnError(f'Promotion on a move that is not one: {san}')
+    return rules.Move(from_sq, to_sq)
+
+
+def move_to_san(state: rules.BoardState, move: rules.Move) -> str:
+    """
+    Standard algebraic notation for a legal move of the side to move. The move is made and taken
+    back to find out whether it gives check, so state is unchanged afterwards
+    :param state:
+    :param move:
+    :return:
+    """
+    from_sq, to_sq, promotion = move
+    code = state.squares[from_sq]
+    kind = code & 7
+    if kind == rules.KING and abs(to_sq - from_sq) == 2:
+        text = 'O-O' if to_sq > from_sq else 'O-O-O'
+    elif kind == rules.PAWN:
+        capture = state.squares[to_sq] or to_sq == state.en_passant
+        text = rules.square_name(from_sq)[0] + 'x' if capture else ''
+        text += rules.square_name(to_sq)
+        if state.is_promotion(from_sq, to_sq):
+            text += '=' + SAN_PIECES[promotion or rules.QUEEN]
+    else:
+        # other pieces of the same kind that could also go there
+        others = [sq for sq in rules.iter_bits(state.bitboards[code] & ~(1 << from_sq)) if state.is_legal(sq, to_sq)]
+        disambiguation = ''
+        if others:
+            from_name = rules.square_name(from_sq)
+            if all(sq & 7 != from_sq & 7 for sq in others):
+                disambiguation = from_name[0]
+            elif all(sq >> 3 != from_sq >> 3 for sq in others):
+                disambiguation = from_name[1]
+            else:
+                disambiguation = from_name
+        text = SAN_PIECES[kind] + disambiguation + ('x' if state.squares[to_sq] else '') + rules.square_name(to_sq)
+    state.make_move(from_sq, to_sq, promotion or rules.QUEEN)
+    if state.in_check(state.side):
+        text += '+' if state.has_legal_move(state.side) else '#'
+    state.unmake_move()
+    return text
+
+
+def read_games(stream: typing.Iterable[bytes]) -> typing.Iterator[PgnGame]:
+    """
+    Yield games one at a time from a binary PGN stream, reading it line by line
+    :param stream: file opened in binary mode, or any iterable of byte lines
+    :return:
+    """
+    headers = {}
+    movetext = []
+    offset = 0
+    start = None
+    in_comment = False  # a { comment in the movetext is still open
+    for line in stream:
+        stripped = line.strip()
+        # only a tag pair outside a comment starts the next game, [%clk ...] inside { } is part of the comment
+        if stripped.startswith(b'[') and movetext and not in_comment and \
+                HEADER_PATTERN.match(stripped.decode('utf-8', errors='replace')):
+            yield _make_game(headers, movetext, start)
+            headers = {}
+            movetext = []
+            start = None
+        if stripped and start is None:
+            start = offset
+        offset += len(line)
+        if not stripped or stripped.startswith(b'%'):
+            continue
+        text = stripped.decode('utf-8', errors='replace')
+        if text.startswith('[') and not movetext:
+            match = HEADER_PATTERN.match(text)
+            if match:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+        else:
+            movetext.append(text)
+            in_comment = _comment_open(text, in_comment)
+    if headers or movetext:
+        yield _make_game(headers, movetext, start)
+
+
+def _comment_open(text: str, in_comment: bool) -> bool:
+    """
+    Whether a { } comment is still open at the end of a line of movetext
+    :param text:
+    :param in_comment: open at the start of the line
+    :return:
+    """
+    if '{' not in text and '}' not in text:
+        return in_comment
+    for char in text:
+        if in_comment:
+            in_comment = char != '}'
+        elif char == '{':
+            in_comment = True
+        elif char == ';':
+            break
+    return in_comment
+
+
+def _make_game(headers: typing.Dict[str, str], movetext: typing.List[str], offset: int) -> PgnGame:
+    moves = []
+    result = headers.get('Result', '*')
+    depth = 0  # variation nesting, only the main line is kept
+    for token in TOKEN_PATTERN.findall('\n'.join(movetext)):
+        first = token[0]
+        if first == '(':
+            depth += 1
+        elif first == ')':
+            depth = max(depth - 1, 0)
+        elif depth or first in '{;$' or token[-1] == '.':
+            continue
+        elif token in RESULTS:
+            result = token
+        else:
+            moves.append(token)
+    return PgnGame(headers, moves, result, offset)
+
+
+def replay_games(games: typing.Iterable[PgnGame]) -> typing.Iterator[ReplayedGame]:
+    """
+    Replay every move of every game against the rules
+    :param games:
+    :return:
+    """
+    for game in games:
+        moves = []
+        try:
+            state = starting_state(game.headers)
+        except PgnError as error:
+            yield ReplayedGame(game, moves, str(error), None)
+            continue
+        error = None
+        for san in game.moves:
+            try:
+                move = parse_san(state, san)
+            except PgnError as exc:
+                error = f'move {state.fullmove_number}{"." if state.side == rules.WHITE else "..."} {exc}'
+                break
+            state.make_move(*move)
+            moves.append(move)
+        yield ReplayedGame(game, moves, error, state)
+
+
+def write_game(stream: typing.TextIO, moves: typing.Sequence[rules.Move], headers: typing.Dict[str, str] = None,
+               start: rules.BoardState = None):
+    """
+    Write one game in export format, followed by a blank line
+    :param stream: text stream
+    :param moves: legal moves from start
+    :param headers: tag pairs, the seven tag roster is filled in with defaults
+    :param start: starting position, the standard one when None
+    :return:
+    """
+    headers = dict(headers or {})
+    state = start.copy() if start is not None else rules.BoardState.from_fen(rules.START_FEN)
+    fen = state.to_fen()
+    if fen != rules.START_FEN:
+        headers.setdefault('SetUp', '1')
+        headers.setdefault('FEN', fen)
+    roster = [(name, headers.pop(name, default)) for name, default in SEVEN_TAG_ROSTER]
+    for name, value in roster + sorted(headers.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        stream.write(f'[{name} "{value}"]\n')
+    stream.write('\n')
+
+    tokens = []
+    for index, move in enumerate(moves):
+        if state.side == rules.WHITE:
+            tokens.append(f'{state.fullmove_number}.')
+        elif index == 0:
+            tokens.append(f'{state.fullmove_number}...')
+        tokens.append(move_to_san(state, move))
+        state.make_move(move.from_sq, move.to_sq, move.promotion or rules.QUEEN)
+    tokens.append(roster[-1][1])
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > LINE_LENGTH:
+            stream.write(line + '\n')
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    stream.write(line + '\n\n')
+
+
+def open_games(filename: str) -> typing.Iterator[PgnGame]:
+    with open(filename, 'rb') as stream:
+        yield from read_games(stream)
+
+
+def replay_file(filename: str, show_errors: int = 10) -> int:
+    """
+    Validate every game in a PGN file, printing a summary with throughput
+    :param filename:
+    :param show_errors: how many failing games to describe
+    :return: number of games with errors
+    """
+    games = plies = errors = 0
+    start = time.perf_counter()
+    for replayed in replay_games(open_games(filename)):
+        games += 1
+        plies += len(replayed.moves)
+        if replayed.error is not None:
+            errors += 1
+            if errors <= show_errors:
+                print(f'game {games} at byte {replayed.game.offset}: {replayed.error}')
+    elapsed = time.perf_counter() - start
+    rate = games / elapsed if elapsed > 0 else 0.0
+    ply_rate = plies / elapsed if elapsed > 0 else 0.0
+    print(f'{games} games, {plies} plies, {errors} with errors in {elapsed:.2f}s: '
+          f'{rate:,.1f} games/sec, {ply_rate:,.0f} plies/sec')
+    return errors
+
+
+def convert_selfplay(filename: str, output: typing.TextIO, layout_filename: str = 'piece_layout.json'):
+    """
+    Write the JSON lines of selfplay.py as PGN
+    :param filename:
+    :param output:
+    :param layout_filename: layout the games were played from
+    :return:
+    """
+    start = rules.BoardState.from_layout(rules.load_layout(layout_filename))
+    with open(filename) as records:
+        for line in records:
+            record = json.loads(line)
+            state = start.copy()
+            moves = [rules.parse_move(uci) for uci in record['moves']]
+            headers = {'Event': 'Self-play', 'Round': record['game'] + 1, 'White': record['white'],
+                       'Black': record['black'], 'Result': record['result'], 'Termination': record['termination']}
+            write_game(output, moves, headers, state)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument('command', choices=['replay', 'convert'])
+    parser.add_argument('filename')
+    parser.add_argument('--layout', default='piece_layout.json', help='layout self-play games started from')
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        if replay_file(args.filename):
+            raise SystemExit(1)
+    else:
+        convert_selfplay(args.filename, sys.stdout, args.layout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+on-disk position index over PGN game databases
+
+Maps the Zobrist hash of every position reached in an archive to where it happened: the byte
+offset of the game in the PGN file and the ply within it. The index file is
+    header      b'PCX1' then the record count (8 bytes, big-endian)
+    records     hash (8 bytes), game offset (8 bytes), ply (2 bytes), sorted by hash
+Building is an external sort: sorted runs of a bounded number of records are written to
+temporary files and merged with heapq.merge, so memory stays flat for any archive size.
+Lookups memory-map the index and binary search it, without reading the archive.
+Commands:
+    build games.pgn games.idx           index every position of every valid game
+    query games.idx --fen FEN           list games that reached a position
+"""
+import argparse
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import time
+import typing
+
+import pgn
+import rules
+
+MAGIC = b'PCX1'
+HEADER = struct.Struct('>4sQ')
+RECORD = struct.Struct('>QQH')
+RUN_RECORDS = 1 << 20  # records sorted in memory at a time while building
+READ_RECORDS = 4096  # records read at a time from each run while merging
+
+
+class Occurrence(typing.NamedTuple):
+    offset: int  # byte offset of the game in the PGN file
+    ply: int  # 0 is the starting position
+
+
+class PositionIndex:
+    def __init__(self, filename: str):
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'{filename} is not a position index')
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, position_hash: int) -> typing.List[Occurrence]:
+        """
+        Every recorded occurrence of a position
+        :param position_hash: BoardState.hash
+        :return:
+        """
+        key = position_hash.to_bytes(8, 'big')
+        # keys are big-endian, so comparing the raw bytes orders them like the numbers
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = HEADER.size + middle * RECORD.size
+            if self.map[start:start + 8] < key:
+                low = middle + 1
+            else:
+                high = middle
+        occurrences = []
+        for index in range(low, self.count):
+            found_hash, offset, ply = RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+            if found_hash != position_hash:
+                break
+            occurrences.append(Occurrence(offset, ply))
+        return occurrences
+
+    def lookup_state(self, state: rules.BoardState) -> typing.List[Occurrence]:
+        return self.lookup(state.hash)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def iter_positions(games: typing.Iterable[pgn.PgnGame]) -> typing.Iterator[typing.Tuple[int, int, int]]:
+    """
+    (hash, game offset, ply) for every position of every game that replays without errors
+    :param games:
+    :return:
+    """
+    for game in games:
+        try:
+            state = pgn.starting_state(game.headers)
+        except pgn.PgnError:
+            continue
+        positions = [(state.hash, game.offset, 0)]
+        for san in game.moves:
+            try:
+                move = pgn.parse_san(state, san)
+            except pgn.PgnError:
+                positions = None
+                break
+            state.make_move(*move)
+            positions.append((state.hash, game.offset, len(positions)))
+        if positions and len(positions) <= 0xffff:
+            yield from positions
+
+
+def _write_run(records: typing.List[typing.Tuple[int, int, int]], directory: str) -> str:
+    records.sort()
+    descriptor, filename = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(descriptor, 'wb') as run:
+        pack = RECORD.pack
+        run.write(b''.join(pack(*record) for record in records))
+    return filename
+
+
+def _read_run(filename: str) -> typing.Iterator[typing.Tuple[int, int, int]]:
+    with open(filename, 'rb') as run:
+        while True:
+            chunk = run.read(RECORD.size * READ_RECORDS)
+            if not chunk:
+                return
+            yield from RECORD.iter_unpack(chunk)
+
+
+def build_index(pgn_filename: str, index_filename: str, run_records: int = RUN_RECORDS) -> int:
+    """
+    Index every position in a PGN file
+    :param pgn_filename:
+    :param index_filename:
+    :param run_records: records sorted in memory at a time
+    :return: number of records written
+    """
+    directory = os.path.dirname(os.path.abspath(index_filename))
+    runs = []
+    try:
+        records = []
+        for record in iter_positions(pgn.open_games(pgn_filename)):
+            records.append(record)
+            if len(records) >= run_records:
+                runs.append(_write_run(records, directory))
+                records = []
+        if records:
+            runs.append(_write_run(records, directory))
+        del records
+        count = 0
+        with open(index_filename, 'wb') as index:
+            index.write(HEADER.pack(MAGIC, 0))
+            pack = RECORD.pack
+            buffer = []
+            for record in heapq.merge(*(_read_run(run) for run in runs)):
+                buffer.append(pack(*record))
+                if len(buffer) >= READ_RECORDS:
+                    index.write(b''.join(buffer))
+                    buffer = []
+                count += 1
+            index.write(b''.join(buffer))
+            index.seek(0)
+            index.write(HEADER.pack(MAGIC, count))
+    finally:
+        for run in runs:
+            os.remove(run)
+    return count
+
+
+def read_game_at(pgn_filename: str, offset: int) -> pgn.PgnGame:
+    with open(pgn_filename, 'rb') as stream:
+        stream.seek(offset)
+        return next(pgn.read_games(stream))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    build = subparsers.add_parser('build', help='index a PGN file')
+    build.add_argument('pgn')
+    build.add_argument('index')
+    build.add_argument('--run-records', type=int, default=RUN_RECORDS, help='records sorted in memory at a time')
+    query = subparsers.add_parser('query', help='find games that reached a position')
+    query.add_argument('index')
+    query.add_argument('--fen', default=rules.START_FEN, help='position to look up (default the start)')
+    query.add_argument('--pgn', help='PGN file the index was built from, to show game headers')
+    query.add_argument('--limit', type=int, default=20, help='occurrences to print (default 20)')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        count = build_index(args.pgn, args.index, args.run_records)
+        elapsed = time.perf_counter() - start
+        print(f'{count} positions indexed in {elapsed:.2f}s, {count / elapsed if elapsed > 0 else 0:,.0f} positions/sec')
+        return
+    state = rules.BoardState.from_fen(args.fen)
+    with PositionIndex(args.index) as index:
+        start = time.perf_counter()
+        occurrences = index.lookup_state(state)
+        elapsed = time.perf_counter() - start
+    print(f'{len(occurrences)} occurrences among {len(index)} positions, found in {elapsed * 1000:.3f}ms')
+    for occurrence in occurrences[:args.limit]:
+        description = ''
+        if args.pgn:
+            headers = read_game_at(args.pgn, occurrence.offset).headers
+            description = f' {headers.get("White", "?")} - {headers.get("Black", "?")} {headers.get("Result", "*")}'
+        print(f'  game at byte {occurrence.offset}, ply {occurrence.ply}{description}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,867 @@
+"""
+headless chess rules core
+
+Game state lives in a compact BoardState: a 64 entry mailbox of piece codes plus one
+bitboard per piece code and per color. Nothing in here imports pygame, so moves can be
+checked without a display. Squares are numbered y * 8 + x using the same x/y coordinates
+as the pygame Board, so a1 is 0 and h8 is 63.
+
+Only make_move and unmake_move change a BoardState. Every query, including legality and
+check tests, just reads it, so queries may run from other threads while no move is being made.
+"""
+import json
+import random
+import typing
+
+import metrics
+
+WHITE = 0
+BLACK = 1
+COLOR_NAMES = ('White', 'Black')
+
+EMPTY = 0
+PAWN = 1
+KNIGHT = 2
+BISHOP = 3
+ROOK = 4
+QUEEN = 5
+KING = 6
+PIECE_NAMES = ('', 'Pawn', 'Knight', 'Bishop', 'Rook', 'Queen', 'King')
+
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+CASTLING_RIGHTS = ((WHITE_KING_SIDE, WHITE_QUEEN_SIDE), (BLACK_KING_SIDE, BLACK_QUEEN_SIDE))
+# castling rights lost when a piece moves from or to a square
+CASTLING_MASKS = {
+    0: WHITE_QUEEN_SIDE,
+    4: WHITE_KING_SIDE | WHITE_QUEEN_SIDE,
+    7: WHITE_KING_SIDE,
+    56: BLACK_QUEEN_SIDE,
+    60: BLACK_KING_SIDE | BLACK_QUEEN_SIDE,
+    63: BLACK_KING_SIDE,
+}
+
+Y_DIRECTION = (1, -1)
+HOME_ROW = (0, 7)
+PAWN_ROW = (1, 6)
+PROMOTION_ROW = (7, 0)
+PROMOTION_KINDS = (QUEEN, KNIGHT, ROOK, BISHOP)
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+FEN_PIECES = ' pnbrqk'
+FEN_CASTLING = (('K', WHITE_KING_SIDE), ('Q', WHITE_QUEEN_SIDE), ('k', BLACK_KING_SIDE), ('q', BLACK_QUEEN_SIDE))
+
+KNIGHT_STEPS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+KING_STEPS = ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))
+# ray directions N, NE, E, SE, S, SW, W, NW; even directions are straight, odd ones diagonal
+DIRECTIONS = KING_STEPS
+# whether squares along a direction get higher numbers, so the nearest blocker is the lowest set bit
+POSITIVE_DIRECTIONS = (True, True, True, False, False, False, False, True)
+
+# check probes are leaves_king_in_check and in_check; entries are added up front so hot paths can just += 1
+_COUNTERS = metrics.counters
+_COUNTERS.update(dict.fromkeys(('can_move', 'leaves_king_in_check', 'in_check', 'make_move', 'unmake_move'), 0))
+
+
+def load_layout(layout_filename: str = 'piece_layout.json') -> dict:
+    with open(layout_filename) as layout_config_file:
+        layout_config = json.load(layout_config_file)
+    return layout_config
+
+
+def square(x: int, y: int) -> int:
+    return y * 8 + x
+
+
+def square_name(sq: int) -> str:
+    return f'{chr((sq & 7) + 97)}{(sq >> 3) + 1}'
+
+
+def piece_code(color: int, kind: int) -> int:
+    return color << 3 | kind
+
+
+def piece_color(code: int) -> int:
+    return code >> 3
+
+
+def piece_kind(code: int) -> int:
+    return code & 7
+
+
+class Move(typing.NamedTuple):
+    from_sq: int
+    to_sq: int
+    promotion: int = EMPTY
+
+    def __str__(self):
+        promotion = FEN_PIECES[self.promotion] if self.promotion else ''
+        return f'{square_name(self.from_sq)}{square_name(self.to_sq)}{promotion}'
+
+
+def parse_move(text: str) -> Move:
+    """
+    Move from coordinate notation, the inverse of str(Move): e2e4, or e7e8q for a promotion
+    :param text:
+    :return:
+    """
+    if (len(text) not in (4, 5) or text[0] not in 'abcdefgh' or text[2] not in 'abcdefgh'
+            or text[1] not in '12345678' or text[3] not in '12345678' or (len(text) == 5 and text[4] not in 'nbrq')):
+        raise ValueError(f'not a move: {text!r}')
+    promotion = FEN_PIECES.index(text[4]) if len(text) == 5 else EMPTY
+    return Move(square(ord(text[0]) - 97, int(text[1]) - 1), square(ord(text[2]) - 97, int(text[3]) - 1), promotion)
+
+
+class MoveDescription(typing.NamedTuple):
+    """
+    Everything a legal move does to the board, worked out without touching it
+    """
+    move: Move
+    piece: int
+    captured: int = EMPTY
+    captured_sq: typing.Optional[int] = None  # differs from move.to_sq for en passant
+    rook_from: typing.Optional[int] = None  # rook relocation of a castle
+    rook_to: typing.Optional[int] = None
+    promotion: int = EMPTY
+
+
+class Undo(typing.NamedTuple):
+    move: Move
+    moved: int
+    captured: int
+    captured_sq: int
+    castling: int
+    en_passant: typing.Optional[int]
+    halfmove_clock: int
+    attacks_from: typing.List[int]
+    attack_maps: typing.List[int]
+    hash: int
+
+
+def iter_bits(bitboard: int) -> typing.Iterator[int]:
+    while bitboard:
+        low = bitboard & -bitboard
+        yield low.bit_length() - 1
+        bitboard ^= low
+
+
+class BoardState:
+    __slots__ = ('squares', 'bitboards', 'occupancy', 'side', 'castling', 'en_passant', 'halfmove_clock',
+                 'fullmove_number', 'attacks_from', 'attack_maps', 'history', 'hash', 'repetitions')
+
+    def __init__(self):
+        self.squares: typing.List[int] = [EMPTY] * 64
+        self.bitboards: typing.List[int] = [0] * 15  # indexed by piece code
+        self.occupancy: typing.List[int] = [0, 0]  # indexed by color
+        self.side = WHITE
+        self.castling = 0
+        self.en_passant: typing.Optional[int] = None  # square a pawn may capture onto en passant
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        # squares attacked by the piece on each square, and by each side as a whole; kept up to date by make_move
+        self.attacks_from: typing.List[int] = [0] * 64
+        self.attack_maps: typing.List[int] = [0, 0]  # indexed by color
+        self.history: typing.List[Undo] = []
+        self.hash = 0  # zobrist hash, kept up to date by put/remove and make_move
+        self.repetitions: typing.Dict[int, int] = {}  # times each hash has occurred in this game
+
+    @classmethod
+    def from_layout(cls, layout_config: dict) -> 'BoardState':
+        """
+        Build a starting position from the piece_layout.json structure
+        :param layout_config:
+        :return:
+        """
+        state = cls()
+        for color, color_name in enumerate(COLOR_NAMES):
+            for kind in range(PAWN, KING + 1):
+                for position in layout_config.get(color_name, {}).get(PIECE_NAMES[kind], []):
+                    state.put(square(position.get('x'), position.get('y')), piece_code(color, kind))
+        # castling is allowed for any king and rook standing on their original squares
+        for color, (king_side, queen_side) in enumerate(CASTLING_RIGHTS):
+            row = HOME_ROW[color]
+            rook = piece_code(color, ROOK)
+            if state.squares[square(4, row)] == piece_code(color, KING):
+                if state.squares[square(7, row)] == rook:
+                    state.castling |= king_side
+                if state.squares[square(0, row)] == rook:
+                    state.castling |= queen_side
+        state.refresh()
+        return state
+
+    @classmethod
+    def from_fen(cls, fen: str) -> 'BoardState':
+        fields = fen.split()
+        state = cls()
+        for row, rank in enumerate(fields[0].split('/')):
+            x = 0
+            for char in rank:
+                if char.isdigit():
+                    x += int(char)
+                    continue
+                color = WHITE if char.isupper() else BLACK
+                state.put(square(x, 7 - row), piece_code(color, FEN_PIECES.index(char.lower())))
+                x += 1
+        state.side = WHITE if len(fields) < 2 or fields[1] == 'w' else BLACK
+        castling = fields[2] if len(fields) > 2 else '-'
+        for char, right in FEN_CASTLING:
+            if char in castling:
+                state.castling |= right
+        if len(fields) > 3 and fields[3] != '-':
+            state.en_passant = square(ord(fields[3][0]) - 97, int(fields[3][1]) - 1)
+        if len(fields) > 5:
+            state.halfmove_clock = int(fields[4])
+            state.fullmove_number = int(fields[5])
+        state.refresh()
+        return state
+
+    def to_fen(self) -> str:
+        rows = []
+        for y in range(7, -1, -1):
+            row = ''
+            empty = 0
+            for x in range(8):
+                code = self.squares[square(x, y)]
+                if not code:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                char = FEN_PIECES[code & 7]
+                row += char.upper() if code >> 3 == WHITE else char
+            rows.append(row + (str(empty) if empty else ''))
+        castling = ''.join(char for char, right in FEN_CASTLING if self.castling & right) or '-'
+        en_passant = square_name(self.en_passant) if self.en_passant is not None else '-'
+        return (f'{"/".join(rows)} {"w" if self.side == WHITE else "b"} {castling} {en_passant} '
+                f'{self.halfmove_clock} {self.fullmove_number}')
+
+    def __repr__(self):
+        return f'<BoardState: {COLOR_NAMES[self.side]} to move>'
+
+    def copy(self) -> 'BoardState':
+        state = BoardState.__new__(BoardState)
+        state.squares = self.squares.copy()
+        state.bitboards = self.bitboards.copy()
+        state.occupancy = self.occupancy.copy()
+        state.side = self.side
+        state.castling = self.castling
+        state.en_passant = self.en_passant
+        state.halfmove_clock = self.halfmove_clock
+        state.fullmove_number = self.fullmove_number
+        state.attacks_from = self.attacks_from.copy()
+        state.attack_maps = self.attack_maps.copy()
+        state.history = self.history.copy()
+        state.hash = self.hash
+        state.repetitions = self.repetitions.copy()
+        return state
+
+    def refresh(self):
+        """
+        Rebuild attack maps and hash from scratch and restart the repetition count, needed after pieces are
+        placed with put/remove directly
+        :return:
+        """
+        self._update_attacks(self.occupancy[0] | self.occupancy[1])
+        self.hash = 0
+        for sq in iter_bits(self.occupancy[0] | self.occupancy[1]):
+            self.hash ^= ZOBRIST_PIECES[self.squares[sq]][sq]
+        self.hash ^= self._state_hash()
+        self.repetitions = {self.hash: 1}
+
+    def _state_hash(self) -> int:
+        """
+        Hash of everything but piece placement: side to move, castling rights and an en passant
+        square a pawn can actually capture onto
+        :return:
+        """
+        key = ZOBRIST_CASTLING[self.castling]
+        if self.side == BLACK:
+            key ^= ZOBRIST_SIDE
+        if self.en_passant is not None and \
+                PAWN_ATTACKS[self.side ^ 1][self.en_passant] & self.bitboards[self.side << 3 | PAWN]:
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant & 7]
+        return key
+
+    def _update_attacks(self, changed: int):
+        """
+        Recompute attacks for the pieces on changed squares and for any slider whose reach crossed one of them,
+        then rebuild each side's attack map
+        :param changed: bitboard of squares whose occupant changed
+        :return:
+        """
+        squares = self.squares
+        # work on a fresh list so the undo stack can hold on to the previous one
+        attacks_from = self.attacks_from = self.attacks_from.copy()
+        bitboards = self.bitboards
+        occupied = self.occupancy[0] | self.occupancy[1]
+        for sq in iter_bits(changed):
+            code = squares[sq]
+            attacks_from[sq] = piece_attacks(code, sq, occupied) if code else 0
+        sliders = (bitboards[BISHOP] | bitboards[ROOK] | bitboards[QUEEN] | bitboards[BLACK << 3 | BISHOP] |
+                   bitboards[BLACK << 3 | ROOK] | bitboards[BLACK << 3 | QUEEN]) & ~changed
+        for sq in iter_bits(sliders):
+            if attacks_from[sq] & changed:
+                attacks_from[sq] = piece_attacks(squares[sq], sq, occupied)
+        attack_maps = [0, 0]
+        for sq in iter_bits(occupied):
+            attack_maps[squares[sq] >> 3] |= attacks_from[sq]
+        self.attack_maps = attack_maps
+
+    def put(self, sq: int, code: int):
+        bit = 1 << sq
+        self.squares[sq] = code
+        self.bitboards[code] |= bit
+        self.occupancy[code >> 3] |= bit
+        self.hash ^= ZOBRIST_PIECES[code][sq]
+
+    def remove(self, sq: int) -> int:
+        code = self.squares[sq]
+        if code:
+            bit = 1 << sq
+            self.squares[sq] = EMPTY
+            self.bitboards[code] ^= bit
+            self.occupancy[code >> 3] ^= bit
+            self.hash ^= ZOBRIST_PIECES[code][sq]
+        return code
+
+    @property
+    def occupied(self) -> int:
+        return self.occupancy[0] | self.occupancy[1]
+
+    def king_square(self, color: int) -> typing.Optional[int]:
+        kings = self.bitboards[piece_code(color, KING)]
+        return kings.bit_length() - 1 if kings else None
+
+    def can_move(self, from_sq: int, to_sq: int) -> bool:
+        """
+        Whether the piece on from_sq moves like that piece may move to to_sq, ignoring whether
+        its own king is left in check
+        :param from_sq:
+        :param to_sq:
+        :return:
+        """
+        _COUNTERS['can_move'] += 1
+        code = self.squares[from_sq]
+        if not code or from_sq == to_sq:
+            return False
+        target = self.squares[to_sq]
+        if target and target >> 3 == code >> 3:
+            return False
+        return _CAN_MOVE[code & 7](self, from_sq, to_sq, code >> 3)
+
+    def is_legal(self, from_sq: int, to_sq: int) -> bool:
+        if not self.can_move(from_sq, to_sq):
+            return False
+        return not self.leaves_king_in_check(from_sq, to_sq)
+
+    def leaves_king_in_check(self, from_sq: int, to_sq: int) -> bool:
+        """
+        Whether moving the piece on from_sq to to_sq exposes its own king, found by checking for attackers
+        with the move applied to a copy of the occupancy bits rather than to the board
+        :param from_sq:
+        :param to_sq:
+        :return:
+        """
+        _COUNTERS['leaves_king_in_check'] += 1
+        code = self.squares[from_sq]
+        color = code >> 3
+        captured_sq = to_sq
+        if code & 7 == PAWN and to_sq == self.en_passant and color == self.side:
+            captured_sq = to_sq - 8 * Y_DIRECTION[color]
+        if code & 7 == KING:
+            king = to_sq
+        else:
+            kings = self.bitboards[color << 3 | KING]
+            if not kings:
+                return False
+            king = kings.bit_length() - 1
+        occupied = (self.occupancy[0] | self.occupancy[1]) & ~(1 << from_sq | 1 << captured_sq) | 1 << to_sq
+        return bool(_attackers(self.bitboards, king, color ^ 1, occupied) & ~(1 << captured_sq))
+
+    def describe_move(self, from_sq: int, to_sq: int, promotion: int = QUEEN) -> typing.Optional[MoveDescription]:
+        """
+        Work out what a move would do without making it
+        :param from_sq:
+        :param to_sq:
+        :param promotion: piece kind a pawn reaching the last row becomes
+        :return: None if the move is not legal
+        """
+        if not self.is_legal(from_sq, to_sq):
+            return None
+        code = self.squares[from_sq]
+        color = code >> 3
+        kind = code & 7
+        if kind == PAWN and to_sq == self.en_passant:
+            captured_sq = to_sq - 8 * Y_DIRECTION[color]
+            return MoveDescription(Move(from_sq, to_sq), code, self.squares[captured_sq], captured_sq)
+        if kind == PAWN and to_sq >> 3 == PROMOTION_ROW[color]:
+            return MoveDescription(Move(from_sq, to_sq, promotion), code, self.squares[to_sq],
+                                   to_sq if self.squares[to_sq] else None, promotion=promotion)
+        if kind == KING and abs(to_sq - from_sq) == 2:
+            if to_sq > from_sq:
+                return MoveDescription(Move(from_sq, to_sq), code, rook_from=to_sq + 1, rook_to=to_sq - 1)
+            return MoveDescription(Move(from_sq, to_sq), code, rook_from=to_sq - 2, rook_to=to_sq + 1)
+        return MoveDescription(Move(from_sq, to_sq), code, self.squares[to_sq], to_sq if self.squares[to_sq] else None)
+
+    def is_attacked(self, sq: int, by_color: int) -> bool:
+        return bool(self.attack_maps[by_color] >> sq & 1)
+
+    def attackers(self, sq: int, by_color: int) -> int:
+        """
+        Bitboard of by_color's pieces attacking sq, found by looking outward from sq with each piece's pattern
+        :param sq:
+        :param by_color:
+        :return:
+        """
+        return _attackers(self.bitboards, sq, by_color, self.occupancy[0] | self.occupancy[1])
+
+    def in_check(self, color: int) -> bool:
+        _COUNTERS['in_check'] += 1
+        kings = self.bitboards[color << 3 | KING]
+        return bool(kings and self.attack_maps[color ^ 1] & kings)
+
+    def pins(self, king: int, color: int) -> typing.Dict[int, int]:
+        """
+        Map each of color's pieces pinned to its king to the squares it may still move to along the pin
+        :param king:
+        :param color:
+        :return:
+        """
+        bitboards = self.bitboards
+        base = (color ^ 1) << 3
+        queens = bitboards[base | QUEEN]
+        snipers = (STRAIGHT_RAYS[king] & (bitboards[base | ROOK] | queens) |
+                   DIAGONAL_RAYS[king] & (bitboards[base | BISHOP] | queens))
+        occupied = self.occupancy[0] | self.occupancy[1]
+        own = self.occupancy[color]
+        pins = {}
+        for sniper in iter_bits(snipers):
+            between = BETWEEN[king][sniper] & occupied
+            if between and between & own == between and not between & (between - 1):
+                pins[between.bit_length() - 1] = BETWEEN[king][sniper] | 1 << sniper
+        return pins
+
+    def pseudo_legal_moves(self, color: int = None) -> typing.Iterator[Move]:
+        """
+        Every move allowed by can_move for color (default side to move), whether or not it
+        leaves that side's king in check
+        :param color:
+        :return:
+        """
+        color = self.side if color is None else color
+        for from_sq in iter_bits(self.occupancy[color]):
+            kind = self.squares[from_sq] & 7
+            if kind == PAWN:
+                for to_sq in iter_bits(_pawn_targets(self, from_sq, color)):
+                    if to_sq >> 3 == PROMOTION_ROW[color]:
+                        for promotion in PROMOTION_KINDS:
+                            yield Move(from_sq, to_sq, promotion)
+                    else:
+                        yield Move(from_sq, to_sq)
+            else:
+                for to_sq in iter_bits(_TARGETS[kind](self, from_sq, color)):
+                    yield Move(from_sq, to_sq)
+
+    def legal_moves(self, color: int = None) -> typing.Iterator[Move]:
+        """
+        Every legal move for color (default side to move). Checks and pins are resolved from the attack maps,
+        only en passant captures need a separate leaves_king_in_check test
+        :param color:
+        :return:
+        """
+        color = self.side if color is None else color
+        kings = self.bitboards[color << 3 | KING]
+        if not kings:
+            yield from self.pseudo_legal_moves(color)
+            return
+        king = kings.bit_length() - 1
+        enemy = color ^ 1
+        own = self.occupancy[color]
+        checkers = self.attackers(king, enemy) if self.attack_maps[enemy] & kings else 0
+        # the king can't step back along the line of a slider checking it, the king itself hides that square
+        danger = self.attack_maps[enemy]
+        for checker in iter_bits(checkers):
+            if self.squares[checker] & 7 in (BISHOP, ROOK, QUEEN):
+                danger |= RAYS[LINE_DIRECTION[checker][king]][king]
+        for to_sq in iter_bits(KING_ATTACKS[king] & ~own & ~danger):
+            yield Move(king, to_sq)
+        if checkers & (checkers - 1):
+            return  # double check, only the king can move
+        if not checkers:
+            for to_sq in iter_bits(_king_targets(self, king, color) & ~KING_ATTACKS[king]):
+                yield Move(king, to_sq)
+            evasions = ~0
+        else:
+            evasions = checkers | BETWEEN[king][checkers.bit_length() - 1]
+        pins = self.pins(king, color)
+        en_passant_bit = 1 << self.en_passant if self.en_passant is not None and color == self.side else 0
+        for from_sq in iter_bits(own ^ kings):
+            kind = self.squares[from_sq] & 7
+            targets = _TARGETS[kind](self, from_sq, color)
+            allowed = evasions & pins.get(from_sq, ~0)
+            if kind == PAWN:
+                if targets & en_passant_bit and not self.leaves_king_in_check(from_sq, self.en_passant):
+                    yield Move(from_sq, self.en_passant)
+                for to_sq in iter_bits(targets & allowed & ~en_passant_bit):
+                    if to_sq >> 3 == PROMOTION_ROW[color]:
+                        for promotion in PROMOTION_KINDS:
+                            yield Move(from_sq, to_sq, promotion)
+                    else:
+                        yield Move(from_sq, to_sq)
+            else:
+                for to_sq in iter_bits(targets & allowed):
+                    yield Move(from_sq, to_sq)
+
+    def has_legal_move(self, color: int) -> bool:
+        for _ in self.legal_moves(color):
+            return True
+        return False
+
+    def is_checkmate(self, color: int) -> bool:
+        return self.in_check(color) and not self.has_legal_move(color)
+
+    def is_stalemate(self, color: int) -> bool:
+        return not self.in_check(color) and not self.has_legal_move(color)
+
+    def is_repetition(self, count: int = 3) -> bool:
+        return self.repetitions.get(self.hash, 0) >= count
+
+    def is_fifty_move_draw(self) -> bool:
+        return self.halfmove_clock >= 100
+
+    def is_insufficient_material(self) -> bool:
+        """
+        Bare kings, or kings and a single bishop or knight, where neither side can ever mate
+        :return:
+        """
+        bitboards = self.bitboards
+        heavy = 0
+        for color in (WHITE, BLACK):
+            base = color << 3
+            heavy |= bitboards[base | PAWN] | bitboards[base | ROOK] | bitboards[base | QUEEN]
+        if heavy:
+            return False
+        minors = 0
+        for color in (WHITE, BLACK):
+            minors |= bitboards[color << 3 | KNIGHT] | bitboards[color << 3 | BISHOP]
+        return not minors & (minors - 1)
+
+    def outcome(self) -> typing.Optional[typing.Tuple[str, str]]:
+        """
+        Result and reason once the game has ended for the side to move
+        :return: e.g. ('1-0', 'checkmate'), or None while the game goes on
+        """
+        if not self.has_legal_move(self.side):
+            if self.in_check(self.side):
+                return ('0-1' if self.side == WHITE else '1-0'), 'checkmate'
+            return '1/2-1/2', 'stalemate'
+        if self.is_repetition():
+            return '1/2-1/2', 'repetition'
+        if self.is_fifty_move_draw():
+            return '1/2-1/2', 'fifty-move rule'
+        if self.is_insufficient_material():
+            return '1/2-1/2', 'insufficient material'
+        return None
+
+    def is_promotion(self, from_sq: int, to_sq: int) -> bool:
+        code = self.squares[from_sq]
+        return code & 7 == PAWN and to_sq >> 3 == PROMOTION_ROW[code >> 3]
+
+    def make_move(self, from_sq: int, to_sq: int, promotion: int = QUEEN):
+        """
+        Apply a move already known to be legal, including the rook hop of a castle, the pawn
+        taken en passant and pawn promotion. Everything needed to take it back is pushed onto history
+        :param from_sq:
+        :param to_sq:
+        :param promotion: piece kind a pawn reaching the last row becomes
+        :return:
+        """
+        _COUNTERS['make_move'] += 1
+        hash_before = self.hash
+        self.hash ^= self._state_hash()
+        moved = code = self.remove(from_sq)
+        color = code >> 3
+        kind = code & 7
+        captured_sq = to_sq
+        captured = self.remove(to_sq)
+        changed = 1 << from_sq | 1 << to_sq
+        en_passant = None
+        if kind == PAWN:
+            if to_sq == self.en_passant:
+                captured_sq = to_sq - 8 * Y_DIRECTION[color]
+                captured = self.remove(captured_sq)
+                changed |= 1 << captured_sq
+            elif abs(to_sq - from_sq) == 16:
+                en_passant = (from_sq + to_sq) // 2
+            elif to_sq >> 3 == PROMOTION_ROW[color]:
+                code = piece_code(color, promotion)
+        elif kind == KING and abs(to_sq - from_sq) == 2:
+            if to_sq > from_sq:
+                self.put(to_sq - 1, self.remove(to_sq + 1))
+                changed |= 1 << (to_sq - 1) | 1 << (to_sq + 1)
+            else:
+                self.put(to_sq + 1, self.remove(to_sq - 2))
+                changed |= 1 << (to_sq + 1) | 1 << (to_sq - 2)
+        self.put(to_sq, code)
+        self.history.append(Undo(Move(from_sq, to_sq, promotion if code != moved else EMPTY), moved, captured,
+                                 captured_sq, self.castling, self.en_passant, self.halfmove_clock, self.attacks_from,
+                                 self.attack_maps, hash_before))
+        self._update_attacks(changed)
+        self.castling &= ~(CASTLING_MASKS.get(from_sq, 0) | CASTLING_MASKS.get(to_sq, 0))
+        self.en_passant = en_passant
+        self.halfmove_clock = 0 if kind == PAWN or captured else self.halfmove_clock + 1
+        if color == BLACK:
+            self.fullmove_number += 1
+        self.side = color ^ 1
+        self.hash ^= self._state_hash()
+        self.repetitions[self.hash] = self.repetitions.get(self.hash, 0) + 1
+
+    def unmake_move(self) -> Move:
+        """
+        Take back the last move made, restoring captured pieces, castling rights, en passant and attack maps
+        :return: the move taken back
+        """
+        _COUNTERS['unmake_move'] += 1
+        undo = self.history.pop()
+        count = self.repetitions[self.hash] - 1
+        if count:
+            self.repetitions[self.hash] = count
+        else:
+            del self.repetitions[self.hash]
+        from_sq, to_sq, _ = undo.move
+        color = undo.moved >> 3
+        self.remove(to_sq)
+        if undo.moved & 7 == KING and abs(to_sq - from_sq) == 2:
+            if to_sq > from_sq:
+                self.put(to_sq + 1, self.remove(to_sq - 1))
+            else:
+                self.put(to_sq - 2, self.remove(to_sq + 1))
+        self.put(from_sq, undo.moved)
+        if undo.captured:
+            self.put(undo.captured_sq, undo.captured)
+        self.castling = undo.castling
+        self.en_passant = undo.en_passant
+        self.halfmove_clock = undo.halfmove_clock
+        self.attacks_from = undo.attacks_from
+        self.attack_maps = undo.attack_maps
+        self.hash = undo.hash
+        if color == BLACK:
+            self.fullmove_number -= 1
+        self.side = color
+        return undo.move
+
+
+def _ray_attacks(direction: int, sq: int, occupied: int) -> int:
+    """
+    Squares a slider on sq reaches in one direction: the whole ray up to and including the first blocker
+    :param direction:
+    :param sq:
+    :param occupied:
+    :return:
+    """
+    ray = RAYS[direction][sq]
+    blockers = ray & occupied
+    if blockers:
+        if POSITIVE_DIRECTIONS[direction]:
+            blocker = (blockers & -blockers).bit_length() - 1
+        else:
+            blocker = blockers.bit_length() - 1
+        ray ^= RAYS[direction][blocker]
+    return ray
+
+
+def _attackers(bitboards: typing.List[int], sq: int, by_color: int, occupied: int) -> int:
+    base = by_color << 3
+    queens = bitboards[base | QUEEN]
+    return (KNIGHT_ATTACKS[sq] & bitboards[base | KNIGHT] | PAWN_ATTACKS[by_color ^ 1][sq] & bitboards[base | PAWN] |
+            KING_ATTACKS[sq] & bitboards[base | KING] |
+            bishop_attacks(sq, occupied) & (bitboards[base | BISHOP] | queens) |
+            rook_attacks(sq, occupied) & (bitboards[base | ROOK] | queens))
+
+
+def piece_attacks(code: int, sq: int, occupied: int) -> int:
+    kind = code & 7
+    if kind == PAWN:
+        return PAWN_ATTACKS[code >> 3][sq]
+    if kind == KNIGHT:
+        return KNIGHT_ATTACKS[sq]
+    if kind == KING:
+        return KING_ATTACKS[sq]
+    attacks = 0
+    if kind != ROOK:
+        attacks = bishop_attacks(sq, occupied)
+    if kind != BISHOP:
+        attacks |= rook_attacks(sq, occupied)
+    return attacks
+
+
+def bishop_attacks(sq: int, occupied: int) -> int:
+    return (_ray_attacks(1, sq, occupied) | _ray_attacks(3, sq, occupied) |
+            _ray_attacks(5, sq, occupied) | _ray_attacks(7, sq, occupied))
+
+
+def rook_attacks(sq: int, occupied: int) -> int:
+    return (_ray_attacks(0, sq, occupied) | _ray_attacks(2, sq, occupied) |
+            _ray_attacks(4, sq, occupied) | _ray_attacks(6, sq, occupied))
+
+
+def _bishop_can_move(state: BoardState, from_sq: int, to_sq: int, color: int) -> bool:
+    return bool(DIAGONAL_RAYS[from_sq] >> to_sq & 1) and not BETWEEN[from_sq][to_sq] & state.occupied
+
+
+def _rook_can_move(state: BoardState, from_sq: int, to_sq: int, color: int) -> bool:
+    return bool(STRAIGHT_RAYS[from_sq] >> to_sq & 1) and not BETWEEN[from_sq][to_sq] & state.occupied
+
+
+def _queen_can_move(state: BoardState, from_sq: int, to_sq: int, color: int) -> bool:
+    return (bool((DIAGONAL_RAYS[from_sq] | STRAIGHT_RAYS[from_sq]) >> to_sq & 1) and
+            not BETWEEN[from_sq][to_sq] & state.occupied)
+
+
+def _knight_can_move(state: BoardState, from_sq: int, to_sq: int, color: int) -> bool:
+    return bool(KNIGHT_ATTACKS[from_sq] >> to_sq & 1)
+
+
+def _pawn_can_move(state: BoardState, from_sq: int, to_sq: int, color: int) -> bool:
+    return bool(_pawn_targets(state, from_sq, color) >> to_sq & 1)
+
+
+def _king_can_move(state: BoardState, from_sq: int, to_sq: int, color: int) -> bool:
+    if KING_ATTACKS[from_sq] >> to_sq & 1:
+        return True
+    if to_sq >> 3 != from_sq >> 3 or abs(to_sq - from_sq) != 2:
+        return False
+    if to_sq > from_sq:
+        right = CASTLING_RIGHTS[color][0]
+        rook_sq = from_sq + 3
+    else:
+        right = CASTLING_RIGHTS[color][1]
+        rook_sq = from_sq - 4
+    if not state.castling & right or state.squares[rook_sq] != piece_code(color, ROOK):
+        return False
+    if BETWEEN[from_sq][rook_sq] & state.occupied:
+        return False
+    # can't castle out of, through or into check
+    passing_sq = (from_sq + to_sq) // 2
+    enemy = color ^ 1
+    return not (state.is_attacked(from_sq, enemy) or state.is_attacked(passing_sq, enemy) or
+                state.is_attacked(to_sq, enemy))
+
+
+def _pawn_targets(state: BoardState, from_sq: int, color: int) -> int:
+    forward = 8 * Y_DIRECTION[color]
+    to_sq = from_sq + forward
+    targets = 0
+    if not state.squares[to_sq]:
+        targets = 1 << to_sq
+        if from_sq >> 3 == PAWN_ROW[color] and not state.squares[to_sq + forward]:
+            targets |= 1 << (to_sq + forward)
+    enemies = state.occupancy[color ^ 1]
+    if state.en_passant is not None and color == state.side:
+        enemies |= 1 << state.en_passant
+    return targets | PAWN_ATTACKS[color][from_sq] & enemies
+
+
+def _knight_targets(state: BoardState, from_sq: int, color: int) -> int:
+    return KNIGHT_ATTACKS[from_sq] & ~state.occupancy[color]
+
+
+def _bishop_targets(state: BoardState, from_sq: int, color: int) -> int:
+    return bishop_attacks(from_sq, state.occupied) & ~state.occupancy[color]
+
+
+def _rook_targets(state: BoardState, from_sq: int, color: int) -> int:
+    return rook_attacks(from_sq, state.occupied) & ~state.occupancy[color]
+
+
+def _queen_targets(state: BoardState, from_sq: int, color: int) -> int:
+    occupied = state.occupied
+    return (bishop_attacks(from_sq, occupied) | rook_attacks(from_sq, occupied)) & ~state.occupancy[color]
+
+
+def _king_targets(state: BoardState, from_sq: int, color: int) -> int:
+    targets = KING_ATTACKS[from_sq] & ~state.occupancy[color]
+    if state.castling & (CASTLING_RIGHTS[color][0] | CASTLING_RIGHTS[color][1]):
+        for to_sq in (from_sq + 2, from_sq - 2):
+            if 0 <= to_sq < 64 and _king_can_move(state, from_sq, to_sq, color):
+                targets |= 1 << to_sq
+    return targets
+
+
+def _build_tables():
+    """
+    Fill the per-square attack tables once at import so move checks are bit lookups instead of square scans
+    :return:
+    """
+    for sq in range(64):
+        x = sq & 7
+        y = sq >> 3
+        for steps, table in ((KNIGHT_STEPS, KNIGHT_ATTACKS), (KING_STEPS, KING_ATTACKS)):
+            for x_step, y_step in steps:
+                if 0 <= x + x_step < 8 and 0 <= y + y_step < 8:
+                    table[sq] |= 1 << square(x + x_step, y + y_step)
+        for color in (WHITE, BLACK):
+            for x_step in (-1, 1):
+                if 0 <= x + x_step < 8 and 0 <= y + Y_DIRECTION[color] < 8:
+                    PAWN_ATTACKS[color][sq] |= 1 << square(x + x_step, y + Y_DIRECTION[color])
+        for direction, (x_step, y_step) in enumerate(DIRECTIONS):
+            between = 0
+            ray_x = x + x_step
+            ray_y = y + y_step
+            while 0 <= ray_x < 8 and 0 <= ray_y < 8:
+                target = square(ray_x, ray_y)
+                RAYS[direction][sq] |= 1 << target
+                BETWEEN[sq][target] = between
+                LINE_DIRECTION[sq][target] = direction
+                between |= 1 << target
+                ray_x += x_step
+                ray_y += y_step
+            if direction % 2:
+                DIAGONAL_RAYS[sq] |= RAYS[direction][sq]
+            else:
+                STRAIGHT_RAYS[sq] |= RAYS[direction][sq]
+
+
+def perft(state: BoardState, depth: int) -> int:
+    """
+    Count the leaf nodes of the legal move tree, the standard move generator correctness check
+    :param state:
+    :param depth:
+    :return:
+    """
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in state.legal_moves():
+        if depth == 1:
+            nodes += 1
+            continue
+        state.make_move(*move)
+        nodes += perft(state, depth - 1)
+        state.unmake_move()
+    return nodes
+
+
+_CAN_MOVE = (None, _pawn_can_move, _knight_can_move, _bishop_can_move, _rook_can_move, _queen_can_move,
+             _king_can_move)
+_TARGETS = (None, _pawn_targets, _knight_targets, _bishop_targets, _rook_targets, _queen_targets, _king_targets)
+
+KNIGHT_ATTACKS: typing.List[int] = [0] * 64
+KING_ATTACKS: typing.List[int] = [0] * 64
+PAWN_ATTACKS: typing.Tuple[typing.List[int], typing.List[int]] = ([0] * 64, [0] * 64)  # indexed by color
+RAYS: typing.List[typing.List[int]] = [[0] * 64 for _ in DIRECTIONS]  # indexed by direction
+STRAIGHT_RAYS: typing.List[int] = [0] * 64
+DIAGONAL_RAYS: typing.List[int] = [0] * 64
+BETWEEN: typing.List[typing.List[int]] = [[0] * 64 for _ in range(64)]  # squares strictly between two aligned squares
+LINE_DIRECTION: typing.List[typing.List[int]] = [[-1] * 64 for _ in range(64)]  # ray direction from one square to another
+_build_tables()
+
+# fixed seed so hashes are stable between runs and can be stored on disk
+_zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES: typing.List[typing.List[int]] = [[_zobrist_random.getrandbits(64) for _ in range(64)] for _ in range(15)]
+ZOBRIST_SIDE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING: typing.List[int] = [0] + [_zobrist_random.getrandbits(64) for _ in range(15)]
+ZOBRIST_EN_PASSANT: typing.List[int] = [_zobrist_random.getrandbits(64) for _ in range(8)]
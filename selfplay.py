@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+headless self-play runner
+
+Plays N games between configurable players across a process pool, starting from the
+piece_layout.json layout, and writes one JSON line per finished game (moves, outcome,
+timing) as soon as it completes. Player specs:
+    random                      uniformly random legal moves
+    engine                      alpha-beta engine, 0.1s per move
+    engine:movetime=0.5         engine with a time budget per move
+    engine:nodes=2000           engine with a node budget per move
+    engine:depth=2              engine searching to a fixed depth
+Options may be combined, e.g. engine:depth=3,nodes=5000
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import time
+import typing
+
+import engine
+import rules
+
+
+class RandomPlayer:
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+
+    def choose(self, state: rules.BoardState) -> rules.Move:
+        return self.random.choice(list(state.legal_moves()))
+
+
+class EnginePlayer:
+    def __init__(self, movetime: float = 0.1, nodes: int = None, depth: int = 64):
+        self.engine = engine.Engine(movetime=movetime, max_nodes=nodes, max_depth=depth)
+
+    def choose(self, state: rules.BoardState) -> rules.Move:
+        return self.engine.search(state).move
+
+
+def create_player(spec: str, seed: int):
+    name, _, options = spec.partition(':')
+    settings = dict(option.split('=', 1) for option in options.split(',') if option)
+    if name == 'random':
+        return RandomPlayer(seed)
+    if name == 'engine':
+        # a fixed depth or node budget alone shouldn't also be cut short by the default time budget
+        default_movetime = 0 if 'depth' in settings or 'nodes' in settings else 0.1
+        return EnginePlayer(movetime=float(settings.get('movetime', default_movetime)),
+                            nodes=int(settings['nodes']) if 'nodes' in settings else None,
+                            depth=int(settings.get('depth', 64)))
+    raise ValueError(f'Unknown player {spec}')
+
+
+def play_game(job: typing.Tuple[int, str, str, dict, int, int]) -> dict:
+    """
+    Play one game to the end or to max_plies
+    :param job: (game index, white spec, black spec, layout config, max plies, seed)
+    :return: JSON-ready record of the game
+    """
+    index, white_spec, black_spec, layout_config, max_plies, seed = job
+    start = time.perf_counter()
+    players = (create_player(white_spec, seed * 2), create_player(black_spec, seed * 2 + 1))
+    state = rules.BoardState.from_layout(layout_config)
+    moves = []
+    outcome = state.outcome()
+    while outcome is None and len(moves) < max_plies:
+        move = players[state.side].choose(state)
+        state.make_move(*move)
+        moves.append(str(move))
+        outcome = state.outcome()
+    result, termination = outcome or ('*', 'max plies')
+    return {
+        'game': index,
+        'white': white_spec,
+        'black': black_spec,
+        'result': result,
+        'termination': termination,
+        'plies': len(moves),
+        'seconds': round(time.perf_counter() - start, 4),
+        'moves': moves,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument('games', type=int, help='number of games to play')
+    parser.add_argument('--white', default='random', help='white player spec (default random)')
+    parser.add_argument('--black', default='random', help='black player spec (default random)')
+    parser.add_argument('--workers', type=int, default=None, help='processes (default one per core)')
+    parser.add_argument('--max-plies', type=int, default=400, help='stop games after this many plies (default 400)')
+    parser.add_argument('--seed', type=int, default=0, help='base random seed (default 0)')
+    parser.add_argument('--layout', default='piece_layout.json', help='starting layout file')
+    parser.add_argument('--output', help='write JSON lines here instead of stdout')
+    args = parser.parse_args()
+
+    layout_config = rules.load_layout(args.layout)
+    jobs = ((index, args.white, args.black, layout_config, args.max_plies, args.seed + index)
+            for index in range(args.games))
+    output = open(args.output, 'w') if args.output else sys.stdout
+    results = {}
+    start = time.perf_counter()
+    try:
+        with multiprocessing.Pool(args.workers) as pool:
+            for record in pool.imap_unordered(play_game, jobs):
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+                results[record['result']] = results.get(record['result'], 0) + 1
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.perf_counter() - start
+    summary = ', '.join(f'{result}: {count}' for result, count in sorted(results.items()))
+    print(f'{args.games} games in {elapsed:.2f}s, {args.games / elapsed:.2f} games/sec ({summary})', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+asyncio game server
+
+Hosts any number of independent games in one process over a line protocol on TCP. Every
+request is one line and gets exactly one reply line, OK followed by the result or ERR followed
+by the reason. Moves use coordinate notation as printed by rules.Move (e2e4, e7e8q).
+    NEW [FEN]           start a game, from the layout start unless a FEN is given: OK ID FEN
+    JOIN ID             attach to a running game: OK ID FEN
+    MOVE e2e4           play a move: OK FEN
+    UNDO                take back the last move: OK FEN
+    GO [SECONDS]        let the engine play the side to move: OK MOVE FEN
+    MOVES               legal moves: OK MOVE...
+    FEN                 current position: OK FEN
+    STATS               OK sessions=N clients=N moves=N moves_per_sec=N
+    QUIT                OK bye, then the server hangs up
+Every other client attached to the same game is sent MOVED MOVE or UNDONE when it changes,
+between replies. A game ends once its last client disconnects.
+
+Rules calls take microseconds and run on the event loop; engine searches run in a process
+pool so they never hold up the other games.
+Commands:
+    serve                       run the server
+    client [--join ID]          type requests at a running server
+    load --sessions 1000        play random games against a server and report moves/sec
+    load --local                the same against a server hosted in the load generator's loop
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import math
+import random
+import select
+import socket
+import sys
+import time
+import typing
+
+import engine
+import rules
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_MOVETIME = 1.0
+MAX_MOVETIME = 10.0
+REPORT_INTERVAL = 5.0  # seconds between sessions and moves/sec log lines
+BACK_RANKS = 0xFF | 0xFF << 56
+
+
+class ServerError(Exception):
+    """
+    ERR reply from the server
+    """
+
+
+class Session:
+    """
+    One game and the clients attached to it
+    """
+    def __init__(self, session_id: int, state: rules.BoardState):
+        self.id = session_id
+        self.state = state
+        self.clients: typing.Set[asyncio.StreamWriter] = set()
+        self.searching = False  # only one engine search per game at a time
+
+    def notify(self, line: str, sender: asyncio.StreamWriter):
+        for client in self.clients:
+            if client is not sender:
+                client.write(f'{line}\n'.encode('ascii'))
+
+
+class GameServer:
+    def __init__(self, layout_filename: str = 'piece_layout.json', search_workers: int = 1,
+                 max_movetime: float = MAX_MOVETIME):
+        """
+        :param layout_filename: starting layout of NEW games without a FEN
+        :param search_workers: engine processes shared by all games
+        :param max_movetime: longest GO search a client may ask for
+        """
+        self.start = rules.BoardState.from_layout(rules.load_layout(layout_filename))
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=search_workers)
+        self.max_movetime = max_movetime
+        self.sessions: typing.Dict[int, Session] = {}
+        self.session_ids = itertools.count(1)
+        self.clients = 0
+        self.moves = 0  # moves played in all games since the server started
+        self.started = time.perf_counter()
+        self.server: asyncio.AbstractServer = None
+        self.commands = {
+            'NEW': self._new,
+            'JOIN': self._join,
+            'MOVE': self._move,
+            'UNDO': self._undo,
+            'GO': self._go,
+            'MOVES': self._moves,
+            'FEN': self._fen,
+            'STATS': self._stats,
+        }
+
+    async def start_serving(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.server = await asyncio.start_server(self._serve_client, host, port)
+        logger.info('Serving on %s', ', '.join(str(sock.getsockname()) for sock in self.server.sockets))
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.pool.shutdown()
+
+    def stats(self) -> typing.Dict[str, float]:
+        elapsed = time.perf_counter() - self.started
+        return {
+            'sessions': len(self.sessions),
+            'clients': self.clients,
+            'moves': self.moves,
+            'moves_per_sec': round(self.moves / elapsed if elapsed > 0 else 0.0, 1),
+        }
+
+    async def report(self, interval: float = REPORT_INTERVAL):
+        """
+        Log sessions and moves/sec over each interval until cancelled
+        :param interval: seconds
+        :return:
+        """
+        moves = self.moves
+        while True:
+            await asyncio.sleep(interval)
+            logger.info('%d sessions, %d clients, %.0f moves/sec', len(self.sessions), self.clients,
+                        (self.moves - moves) / interval)
+            moves = self.moves
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients += 1
+        session = None
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # the rest of the line is still to come, so there is no telling where the next request starts
+                    writer.write(b'ERR line too long\n')
+                    break
+                if not line:
+                    break
+                try:
+                    words = line.decode('ascii').split()
+                except UnicodeDecodeError:
+                    writer.write(b'ERR requests must be ASCII\n')
+                    await writer.drain()
+                    continue
+                if not words:
+                    continue
+                command = words[0].upper()
+                if command == 'QUIT':
+                    writer.write(b'OK bye\n')
+                    break
+                handler = self.commands.get(command)
+                if handler is None:
+                    reply = f'ERR unknown command {command}'
+                elif session is None and command not in ('NEW', 'JOIN', 'STATS'):
+                    reply = 'ERR no game, send NEW or JOIN first'
+                else:
+                    try:
+                        session, reply = await handler(session, words[1:], writer)
+                        reply = f'OK {reply}' if reply else 'OK'
+                    except ServerError as error:
+                        reply = f'ERR {error}'
+                    except Exception:
+                        # a bug in one request shouldn't cost the client its connection
+                        logger.exception('%s failed', ' '.join(words))
+                        reply = 'ERR internal error'
+                writer.write(f'{reply}\n'.encode('ascii', 'replace'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._leave(session, writer)
+            self.clients -= 1
+            writer.close()
+
+    def _leave(self, session: typing.Optional[Session], writer: asyncio.StreamWriter):
+        if session is None:
+            return
+        session.clients.discard(writer)
+        if not session.clients:
+            del self.sessions[session.id]
+
+    async def _new(self, session: typing.Optional[Session], args: typing.List[str], writer: asyncio.StreamWriter):
+        if args:
+            try:
+                state = rules.BoardState.from_fen(' '.join(args))
+            except (ValueError, IndexError) as error:
+                raise ServerError(f'bad FEN: {error}')
+            _check_position(state)
+        else:
+            state = self.start.copy()
+        self._leave(session, writer)
+        session = Session(next(self.session_ids), state)
+        session.clients.add(writer)
+        self.sessions[session.id] = session
+        return session, f'{session.id} {state.to_fen()}'
+
+    async def _join(self, session: typing.Optional[Session], args: typing.List[str], writer: asyncio.StreamWriter):
+        if len(args) != 1 or not args[0].isdigit() or int(args[0]) not in self.sessions:
+            raise ServerError('no such game')
+        joined = self.sessions[int(args[0])]
+        if joined is not session:
+            self._leave(session, writer)
+            joined.clients.add(writer)
+        return joined, f'{joined.id} {joined.state.to_fen()}'
+
+    async def _move(self, session: Session, args: typing.List[str], writer: asyncio.StreamWriter):
+        if len(args) != 1:
+            raise ServerError('usage: MOVE e2e4')
+        try:
+            move = rules.parse_move(args[0])
+        except ValueError as error:
+            raise ServerError(str(error))
+        self._play(session, move, writer)
+        return session, session.state.to_fen()
+
+    def _play(self, session: Session, move: rules.Move, writer: asyncio.StreamWriter):
+        state = session.state
+        if session.searching:
+            raise ServerError('engine is thinking')
+        if state.outcome() is not None:
+            raise ServerError('game over')
+        if state.squares[move.from_sq] >> 3 != state.side or not state.is_legal(move.from_sq, move.to_sq):
+            raise ServerError(f'illegal move {move}')
+        promotion = move.promotion if state.is_promotion(move.from_sq, move.to_sq) else rules.EMPTY
+        state.make_move(move.from_sq, move.to_sq, promotion or rules.QUEEN)
+        self.moves += 1
+        session.notify(f'MOVED {state.history[-1].move}', writer)
+
+    async def _undo(self, session: Session, args: typing.List[str], writer: asyncio.StreamWriter):
+        if session.searching:
+            raise ServerError('engine is thinking')
+        if not session.state.history:
+            raise ServerError('no moves to take back')
+        session.state.unmake_move()
+        session.notify('UNDONE', writer)
+        return session, session.state.to_fen()
+
+    async def _go(self, session: Session, args: typing.List[str], writer: asyncio.StreamWriter):
+        try:
+            movetime = float(args[0]) if args else DEFAULT_MOVETIME
+        except ValueError:
+            raise ServerError('usage: GO [SECONDS]')
+        # the engine takes 0 as no time limit, which would hold a shared search process indefinitely
+        if not math.isfinite(movetime) or movetime <= 0:
+            raise ServerError('GO needs a number of seconds above 0')
+        movetime = min(movetime, self.max_movetime)
+        if session.searching:
+            raise ServerError('engine is thinking')
+        if session.state.outcome() is not None:
+            raise ServerError('game over')
+        root = session.state.copy()
+        root.history = []  # don't ship the undo stack to the search process
+        session.searching = True
+        try:
+            loop = asyncio.get_event_loop()
+            _, result = await loop.run_in_executor(self.pool, engine._search_share, root, None, movetime)
+        finally:
+            session.searching = False
+        self._play(session, result.move, writer)
+        return session, f'{session.state.history[-1].move} {session.state.to_fen()}'
+
+    async def _moves(self, session: Session, args: typing.List[str], writer: asyncio.StreamWriter):
+        return session, ' '.join(str(move) for move in session.state.legal_moves())
+
+    async def _fen(self, session: Session, args: typing.List[str], writer: asyncio.StreamWriter):
+        return session, session.state.to_fen()
+
+    async def _stats(self, session: typing.Optional[Session], args: typing.List[str], writer: asyncio.StreamWriter):
+        return session, ' '.join(f'{name}={value}' for name, value in self.stats().items())
+
+
+def _check_position(state: rules.BoardState):
+    """
+    Refuse positions the move generator can't handle: each side needs one king, pawns can't stand on
+    the first or last rank, and the side that just moved can't be left in check
+    :param state:
+    :return:
+    """
+    for color in (rules.WHITE, rules.BLACK):
+        if bin(state.bitboards[rules.piece_code(color, rules.KING)]).count('1') != 1:
+            raise ServerError(f'bad FEN: {rules.COLOR_NAMES[color]} needs exactly one king')
+        if state.bitboards[rules.piece_code(color, rules.PAWN)] & BACK_RANKS:
+            raise ServerError(f'bad FEN: {rules.COLOR_NAMES[color]} has a pawn on the first or last rank')
+    if state.in_check(state.side ^ 1):
+        raise ServerError(f'bad FEN: {rules.COLOR_NAMES[state.side ^ 1]} is in check but not to move')
+
+
+class AsyncClient:
+    """
+    Client for tests and load generation, in the same event loop as anything else
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.notifications: typing.List[str] = []  # MOVED and UNDONE lines received between replies
+
+    @classmethod
+    async def connect(cls, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> 'AsyncClient':
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, line: str) -> str:
+        """
+        Send one request and wait for its reply
+        :param line: without the newline
+        :return: the reply after OK
+        """
+        self.writer.write(f'{line}\n'.encode('ascii'))
+        while True:
+            reply = (await self.reader.readline()).decode('ascii').rstrip('\n')
+            if not reply:
+                raise ConnectionError('server hung up')
+            if reply.startswith('OK'):
+                return reply[3:]
+            if reply.startswith('ERR'):
+                raise ServerError(reply[4:])
+            self.notifications.append(reply)
+
+    async def close(self):
+        try:
+            await self.request('QUIT')
+        except (ConnectionError, ServerError):
+            pass
+        self.writer.close()
+
+
+class RemoteGame:
+    """
+    Blocking client for the pygame game, which polls it once per pass of its own loop
+    """
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, session_id: int = None, fen: str = None):
+        """
+        :param host:
+        :param port:
+        :param session_id: game to join, a new one is started when None
+        :param fen: starting position of a new game
+        """
+        self.socket = socket.create_connection((host, port))
+        self.buffer = b''
+        self.notifications: typing.List[str] = []
+        reply = self.request(f'JOIN {session_id}' if session_id is not None else f'NEW {fen or ""}'.rstrip())
+        session_id, self.fen = reply.split(' ', 1)
+        self.id = int(session_id)
+
+    def _read_line(self) -> str:
+        while b'\n' not in self.buffer:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ConnectionError('server hung up')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.decode('ascii')
+
+    def request(self, line: str) -> str:
+        self.socket.sendall(f'{line}\n'.encode('ascii'))
+        while True:
+            reply = self._read_line()
+            if reply.startswith('OK'):
+                return reply[3:]
+            if reply.startswith('ERR'):
+                raise ServerError(reply[4:])
+            self.notifications.append(reply)
+
+    def new_game(self, fen: str = None):
+        session_id, self.fen = self.request(f'NEW {fen or ""}'.rstrip()).split(' ', 1)
+        self.id = int(session_id)
+
+    def send_move(self, move: rules.Move):
+        self.request(f'MOVE {move}')
+
+    def undo(self):
+        self.request('UNDO')
+
+    def poll(self) -> typing.List[str]:
+        """
+        MOVED and UNDONE lines sent by the server since the last poll, without blocking
+        :return:
+        """
+        while select.select([self.socket], [], [], 0)[0]:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ConnectionError('server hung up')
+            self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            self.notifications.append(line.decode('ascii'))
+        notifications, self.notifications = self.notifications, []
+        return notifications
+
+    def close(self):
+        try:
+            self.request('QUIT')
+        except (ConnectionError, ServerError, OSError):
+            pass
+        self.socket.close()
+
+
+async def _play_random_games(host: str, port: int, plies: int, chooser: random.Random) -> int:
+    """
+    One load generator client: random legal moves until its share of plies is played
+    :return: moves played
+    """
+    client = await AsyncClient.connect(host, port)
+    played = 0
+    try:
+        await client.request('NEW')
+        while played < plies:
+            moves = (await client.request('MOVES')).split()
+            if not moves:
+                await client.request('NEW')
+                continue
+            try:
+                await client.request(f'MOVE {chooser.choice(moves)}')
+            except ServerError:
+                await client.request('NEW')  # drawn by repetition or the fifty-move rule
+                continue
+            played += 1
+    finally:
+        await client.close()
+    return played
+
+
+async def run_load(host: str, port: int, sessions: int, plies: int, seed: int = 0) -> typing.Tuple[int, float]:
+    """
+    Play random games in many sessions at once
+    :param host:
+    :param port:
+    :param sessions: concurrent clients, each with its own game
+    :param plies: moves each client plays
+    :param seed:
+    :return: (moves played, seconds)
+    """
+    start = time.perf_counter()
+    counts = await asyncio.gather(*(_play_random_games(host, port, plies, random.Random(seed + index))
+                                    for index in range(sessions)))
+    return sum(counts), time.perf_counter() - start
+
+
+async def _load(args, server: GameServer = None):
+    reporter = None
+    if server is not None:
+        await server.start_serving(args.host, args.port)
+        reporter = asyncio.ensure_future(server.report(args.report))
+    try:
+        moves, elapsed = await run_load(args.host, args.port, args.sessions, args.plies, args.seed)
+    finally:
+        if server is not None:
+            reporter.cancel()
+            await server.close()
+    print(f'{args.sessions} sessions, {moves} moves in {elapsed:.2f}s, {moves / elapsed:,.0f} moves/sec')
+
+
+def _client(args):
+    remote = RemoteGame(args.host, args.port, args.join)
+    print(f'game {remote.id}: {remote.fen}')
+    try:
+        for line in sys.stdin:
+            for notification in remote.poll():
+                print(notification)
+            if not line.strip():
+                continue
+            try:
+                print(remote.request(line.strip()))
+            except ServerError as error:
+                print(f'error: {error}')
+            if line.strip().upper() == 'QUIT':
+                break
+    finally:
+        remote.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'address (default {DEFAULT_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'port (default {DEFAULT_PORT})')
+    parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    serve = subparsers.add_parser('serve', help='run the server')
+    serve.add_argument('--workers', type=int, default=1, help='engine search processes (default 1)')
+    serve.add_argument('--layout', default='piece_layout.json', help='starting layout of new games')
+    serve.add_argument('--report', type=float, default=REPORT_INTERVAL,
+                       help=f'seconds between sessions and moves/sec log lines (default {REPORT_INTERVAL:g})')
+    client = subparsers.add_parser('client', help='type requests at a running server')
+    client.add_argument('--join', type=int, help='game to join instead of starting one')
+    load = subparsers.add_parser('load', help='play random games against a server')
+    load.add_argument('--sessions', type=int, default=100, help='concurrent games (default 100)')
+    load.add_argument('--plies', type=int, default=100, help='moves played in each (default 100)')
+    load.add_argument('--seed', type=int, default=0, help='base random seed (default 0)')
+    load.add_argument('--local', action='store_true', help="host the server in the load generator's own loop")
+    load.add_argument('--report', type=float, default=REPORT_INTERVAL, help='seconds between log lines with --local')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(message)s')
+
+    if args.command == 'client':
+        _client(args)
+        return
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        if args.command == 'load':
+            loop.run_until_complete(_load(args, GameServer() if args.local else None))
+            return
+        server = GameServer(args.layout, args.workers)
+        loop.run_until_complete(server.start_serving(args.host, args.port))
+        reporter = asyncio.ensure_future(server.report(args.report))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        reporter.cancel()
+        loop.run_until_complete(server.close())
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
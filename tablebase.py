@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+endgame tablebases for king and up to two pieces against a lone king
+
+Tables are generated by retrograde analysis: starting from every checkmate, positions are
+resolved one ply further from mate at a time, so each win or loss comes with its distance
+to mate. Tables are written for the strong side playing White. Black-strong positions are probed
+by mirroring the board. Pawnless tables store only the positions with the white king in the
+a1-d1-d4 triangle, and pawn tables only those with the white king on files a-d. Every other
+position is one of these after a rotation or reflection.
+
+File layout: b'PCTB', the table name padded to 4 bytes, then one byte per position
+    0       draw (or a position that can't occur)
+    n > 0   mate in n - 1 plies: a win if White is to move, a loss if Black is
+Tables are memory-mapped for probing. Generation runs on a process pool.
+Commands:
+    generate [KQK KRK KBNK KPK]     write tables to the tablebase directory
+    probe --fen FEN                 look a position up
+"""
+import argparse
+import array
+import mmap
+import multiprocessing
+import os
+import time
+import typing
+
+import rules
+
+MAGIC = b'PCTB'
+HEADER_SIZE = 8
+DEFAULT_DIRECTORY = 'tablebases'
+CHUNK_SIZE = 1 << 14  # positions handed to a worker at a time
+MAX_PIECES = 4
+
+
+def _transform(sq: int, flip_x: bool, flip_y: bool, swap: bool) -> int:
+    x = sq & 7
+    y = sq >> 3
+    if swap:
+        x, y = y, x
+    if flip_x:
+        x = 7 - x
+    if flip_y:
+        y = 7 - y
+    return y * 8 + x
+
+
+# the 8 symmetries of the board as square lookup tables, identity first
+ALL_TRANSFORMS = [[_transform(sq, flip_x, flip_y, swap) for sq in range(64)]
+                  for swap in (False, True) for flip_y in (False, True) for flip_x in (False, True)]
+MIRROR_TRANSFORMS = ALL_TRANSFORMS[:2]  # pawns only allow mirroring files
+TRIANGLE = [rules.square(x, y) for x in range(4) for y in range(x + 1)]  # a1-d1-d4
+
+
+class TableSpec:
+    def __init__(self, name: str, kinds: typing.Tuple[int, ...], dependencies: typing.Tuple[str, ...] = ()):
+        """
+        :param name:
+        :param kinds: white pieces besides the king, in index order
+        :param dependencies: tables that positions after a promotion are looked up in
+        """
+        self.name = name
+        self.kinds = kinds
+        self.codes = tuple(rules.piece_code(rules.WHITE, kind) for kind in kinds)
+        self.dependencies = dependencies
+        self.has_pawn = rules.PAWN in kinds
+        if self.has_pawn:
+            transforms = MIRROR_TRANSFORMS
+            self.king_squares = [sq for sq in range(64) if sq & 7 < 4]
+        else:
+            transforms = ALL_TRANSFORMS
+            self.king_squares = TRIANGLE
+        self.king_index = [-1] * 64
+        for index, sq in enumerate(self.king_squares):
+            self.king_index[sq] = index
+        # the symmetries that bring a white king on each square into the stored region
+        self.king_transforms = [[transform for transform in transforms if self.king_index[transform[sq]] >= 0]
+                                for sq in range(64)]
+        self.size = 2 * len(self.king_squares) * 64 ** (len(kinds) + 1)
+
+    def index(self, side: int, white_king: int, black_king: int, squares: typing.Sequence[int]) -> int:
+        """
+        Table index of a position, after bringing it into the stored region
+        :param side: side to move
+        :param white_king:
+        :param black_king:
+        :param squares: squares of the other white pieces, in kinds order
+        :return:
+        """
+        transforms = self.king_transforms[white_king]
+        transform = transforms[0]
+        if len(transforms) > 1:
+            # king on the diagonal, either reflection works, take the one with the lowest index
+            transform = min(transforms, key=lambda t: [t[black_king]] + [t[sq] for sq in squares])
+        index = (side * len(self.king_squares) + self.king_index[transform[white_king]]) * 64 + transform[black_king]
+        for sq in squares:
+            index = index * 64 + transform[sq]
+        return index
+
+    def decode(self, index: int) -> typing.Tuple[int, int, int, typing.List[int]]:
+        squares = []
+        for _ in self.kinds:
+            index, sq = divmod(index, 64)
+            squares.append(sq)
+        squares.reverse()
+        index, black_king = divmod(index, 64)
+        side, king = divmod(index, len(self.king_squares))
+        return side, self.king_squares[king], black_king, squares
+
+    def attacks(self, white_king: int, squares: typing.Sequence[int], occupied: int) -> int:
+        attacks = rules.KING_ATTACKS[white_king]
+        for code, sq in zip(self.codes, squares):
+            attacks |= rules.piece_attacks(code, sq, occupied)
+        return attacks
+
+    def is_legal(self, side: int, white_king: int, black_king: int, squares: typing.Sequence[int]) -> bool:
+        occupied = 1 << white_king | 1 << black_king
+        for sq in squares:
+            if occupied >> sq & 1:
+                return False
+            occupied |= 1 << sq
+        if rules.KING_ATTACKS[white_king] >> black_king & 1:
+            return False
+        if self.has_pawn and any(kind == rules.PAWN and not 8 <= sq < 56 for kind, sq in zip(self.kinds, squares)):
+            return False
+        # the side not to move can't be in check
+        return side == rules.BLACK or not self.attacks(white_king, squares, occupied) >> black_king & 1
+
+
+SPECS = {spec.name: spec for spec in (
+    TableSpec('KQK', (rules.QUEEN,)),
+    TableSpec('KRK', (rules.ROOK,)),
+    TableSpec('KBNK', (rules.KNIGHT, rules.BISHOP)),
+    TableSpec('KPK', (rules.PAWN,), dependencies=('KQK', 'KRK')),
+)}
+SPECS_BY_KINDS = {spec.kinds: spec for spec in SPECS.values()}
+
+
+class Probe(typing.NamedTuple):
+    wdl: int  # 1 win, 0 draw, -1 loss for the side to move
+    plies: int  # plies to mate, 0 for a draw
+
+    def __str__(self):
+        if not self.wdl:
+            return 'draw'
+        return f'{"win" if self.wdl > 0 else "loss"}, mate in {self.plies} plies'
+
+
+def table_filename(directory: str, name: str) -> str:
+    return os.path.join(directory, f'{name}.tb')
+
+
+def _open_table(filename: str) -> mmap.mmap:
+    with open(filename, 'rb') as file:
+        table = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if table[:4] != MAGIC:
+        table.close()
+        raise ValueError(f'{filename} is not a tablebase')
+    return table
+
+
+class Tablebases:
+    def __init__(self, directory: str = DEFAULT_DIRECTORY):
+        """
+        Open every table found in directory, missing tables are simply not probed
+        :param directory:
+        """
+        self.tables = {}
+        for name in SPECS:
+            filename = table_filename(directory, name)
+            if os.path.exists(filename):
+                self.tables[name] = _open_table(filename)
+
+    def __bool__(self):
+        return bool(self.tables)
+
+    def probe(self, state: rules.BoardState) -> typing.Optional[Probe]:
+        """
+        Result of a position with best play, None when no table covers it
+        :param state:
+        :return:
+        """
+        occupancy = state.occupancy
+        if state.castling or bin(occupancy[0] | occupancy[1]).count('1') > MAX_PIECES:
+            return None
+        for strong in (rules.WHITE, rules.BLACK):
+            weak = strong ^ 1
+            if occupancy[weak] != state.bitboards[weak << 3 | rules.KING]:
+                continue
+            # the tables have the strong side as White, so mirror the board when it is Black
+            flip = 56 if strong == rules.BLACK else 0
+            pieces = sorted((state.squares[sq] & 7, sq ^ flip) for sq in rules.iter_bits(occupancy[strong]))
+            kinds = tuple(kind for kind, _ in pieces[:-1])  # the king sorts last
+            spec = SPECS_BY_KINDS.get(kinds)
+            if spec is None or spec.name not in self.tables:
+                return None
+            side = state.side ^ strong
+            index = spec.index(side, pieces[-1][1], state.king_square(weak) ^ flip, [sq for _, sq in pieces[:-1]])
+            value = self.tables[spec.name][HEADER_SIZE + index]
+            if not value:
+                return Probe(0, 0)
+            return Probe(1 if side == rules.WHITE else -1, value - 1)
+        return None
+
+    def best_move(self, state: rules.BoardState) -> typing.Optional[typing.Tuple[rules.Move, Probe]]:
+        """
+        The move keeping the best result, mating fastest when winning and lasting longest when losing
+        :param state:
+        :return: the move and the result after it from the mover's point of view, None when not covered
+        """
+        if self.probe(state) is None:
+            return None
+        state = state.copy()
+        best = None
+        best_key = None
+        for move in state.legal_moves():
+            state.make_move(*move)
+            reply = self.probe(state)
+            if reply is None and state.is_insufficient_material():
+                reply = Probe(0, 0)
+            state.unmake_move()
+            if reply is None:
+                continue  # e.g. an underpromotion into a table that wasn't generated
+            result = Probe(-reply.wdl, reply.plies + 1 if reply.wdl else 0)
+            key = (result.wdl, -result.plies if result.wdl > 0 else result.plies)
+            if best_key is None or key > best_key:
+                best = (move, result)
+                best_key = key
+        return best
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+
+
+_worker_tables: typing.Dict[tuple, mmap.mmap] = {}
+
+
+def _worker_table(filename: str) -> mmap.mmap:
+    # tables are mapped once per worker. The one being generated is shared, so workers see it fill in.
+    # Keyed by inode as well, so a regenerated file is mapped afresh
+    key = (filename, os.stat(filename).st_ino)
+    table = _worker_tables.get(key)
+    if table is None:
+        table = _worker_tables[key] = _open_table(filename)
+    return table
+
+
+def _black_can_hold(spec: TableSpec, table, white_king: int, black_king: int, squares: typing.List[int]) -> bool:
+    """
+    Whether Black to move has a move that is not yet known to lose
+    """
+    occupied = 1 << white_king | 1 << black_king
+    for sq in squares:
+        occupied |= 1 << sq
+    white = occupied & ~(1 << black_king)
+    # slider attacks pass through the king's square, it can't step back along the line
+    attacked = spec.attacks(white_king, squares, white)
+    for to_sq in rules.iter_bits(rules.KING_ATTACKS[black_king] & ~attacked):
+        if white >> to_sq & 1:
+            return True  # takes an undefended piece
+        if not table[HEADER_SIZE + spec.index(rules.WHITE, white_king, to_sq, squares)]:
+            return True
+    return False
+
+
+def _initial_chunk(job: typing.Tuple[str, str, int, int]) -> typing.Tuple[array.array, typing.List[tuple]]:
+    """
+    Find the checkmates in a range of the table, and for pawn tables, the promotions that win
+    :param job: (table name, directory, first index, end index)
+    :return: mated indices and (index, plies) of wins by promotion
+    """
+    name, directory, start, end = job
+    spec = SPECS[name]
+    mated = array.array('I')
+    promotions = []
+    promotion_tables = [(SPECS[dependency], _worker_table(table_filename(directory, dependency)))
+                        for dependency in spec.dependencies]
+    for index in range(start, end):
+        side, white_king, black_king, squares = spec.decode(index)
+        if not spec.is_legal(side, white_king, black_king, squares):
+            continue
+        if spec.index(side, white_king, black_king, squares) != index:
+            continue  # stored under another reflection
+        if side == rules.BLACK:
+            occupied = 1 << white_king | 1 << black_king
+            for sq in squares:
+                occupied |= 1 << sq
+            attacked = spec.attacks(white_king, squares, occupied & ~(1 << black_king))
+            if attacked >> black_king & 1 and not rules.KING_ATTACKS[black_king] & ~attacked:
+                mated.append(index)
+        elif spec.has_pawn:
+            pawn = squares[0]
+            to_sq = pawn + 8
+            if to_sq < 56 or to_sq in (white_king, black_king):
+                continue
+            best = None
+            for promotion_spec, promotion_table in promotion_tables:
+                value = promotion_table[HEADER_SIZE + promotion_spec.index(rules.BLACK, white_king, black_king, [to_sq])]
+                if value and (best is None or value < best):
+                    best = value
+            if best is not None:
+                promotions.append((index, best))  # Black loses in best - 1 plies, so White wins in best
+    return mated, promotions
+
+
+def _retrograde_chunk(job: typing.Tuple[str, str, int, bytes]) -> array.array:
+    """
+    Positions that become resolved one ply before a set of just resolved ones
+    :param job: (table name, directory, side to move in the resolved positions, their indices)
+    :return: indices of newly won (Black resolved) or lost (White resolved) positions, possibly repeated
+    """
+    name, directory, side, indices = job
+    spec = SPECS[name]
+    table = _worker_table(table_filename(directory, name) + '.tmp')
+    found = array.array('I')
+    for index in array.array('I', indices):
+        _, white_king, black_king, squares = spec.decode(index)
+        occupied = 1 << white_king | 1 << black_king
+        for sq in squares:
+            occupied |= 1 << sq
+        empty = ~occupied
+        if side == rules.BLACK:
+            # Black is lost here, so White wins wherever it could have moved from
+            # the table is checked first, it is much cheaper than legality and most predecessors are known
+            for from_sq in rules.iter_bits(rules.KING_ATTACKS[white_king] & empty):
+                previous = spec.index(rules.WHITE, from_sq, black_king, squares)
+                if not table[HEADER_SIZE + previous] and spec.is_legal(rules.WHITE, from_sq, black_king, squares):
+                    found.append(previous)
+            for piece, (code, sq) in enumerate(zip(spec.codes, squares)):
+                if code & 7 == rules.PAWN:
+                    origins = []
+                    if sq >= 16 and empty >> (sq - 8) & 1:
+                        origins.append(sq - 8)
+                        if sq >> 3 == 3 and empty >> (sq - 16) & 1:
+                            origins.append(sq - 16)
+                else:
+                    origins = rules.iter_bits(rules.piece_attacks(code, sq, occupied) & empty)
+                for from_sq in origins:
+                    before = squares[:piece] + [from_sq] + squares[piece + 1:]
+                    previous = spec.index(rules.WHITE, white_king, black_king, before)
+                    if not table[HEADER_SIZE + previous] and spec.is_legal(rules.WHITE, white_king, black_king, before):
+                        found.append(previous)
+        else:
+            # White wins here, Black is lost wherever it could have moved from if every other move loses too
+            for from_sq in rules.iter_bits(rules.KING_ATTACKS[black_king] & empty & ~rules.KING_ATTACKS[white_king]):
+                previous = spec.index(rules.BLACK, white_king, from_sq, squares)
+                if not table[HEADER_SIZE + previous] and not _black_can_hold(spec, table, white_king, from_sq, squares):
+                    found.append(previous)
+    return found
+
+
+def generate(name: str, directory: str = DEFAULT_DIRECTORY, pool: multiprocessing.Pool = None) -> Probe:
+    """
+    Generate one table, its dependencies must already exist
+    :param name:
+    :param directory:
+    :param pool: worker processes, the work runs in this process when None
+    :return: the longest win in the table
+    """
+    spec = SPECS[name]
+    filename = table_filename(directory, name)
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(MAGIC + name.ljust(4).encode('ascii'))
+        file.truncate(HEADER_SIZE + spec.size)
+    mapper = pool.imap_unordered if pool is not None else map
+    file = open(temporary, 'r+b')
+    table = mmap.mmap(file.fileno(), 0)
+    try:
+        frontier = array.array('I')
+        promotions = {}
+        jobs = ((name, directory, start, min(start + CHUNK_SIZE, spec.size))
+                for start in range(0, spec.size, CHUNK_SIZE))
+        for mated, promoted in mapper(_initial_chunk, jobs):
+            frontier.extend(mated)
+            for index, plies in promoted:
+                promotions.setdefault(plies, []).append(index)
+        for index in frontier:
+            table[HEADER_SIZE + index] = 1
+        plies = 0
+        side = rules.BLACK  # side to move in the frontier, the one being mated at even plies
+        while frontier or promotions:
+            found = array.array('I')
+            jobs = ((name, directory, side, frontier[start:start + CHUNK_SIZE].tobytes())
+                    for start in range(0, len(frontier), CHUNK_SIZE))
+            for previous in mapper(_retrograde_chunk, jobs):
+                for index in previous:
+                    if not table[HEADER_SIZE + index]:
+                        table[HEADER_SIZE + index] = plies + 2
+                        found.append(index)
+            plies += 1
+            side ^= 1
+            for index in promotions.pop(plies, ()):
+                if not table[HEADER_SIZE + index]:
+                    table[HEADER_SIZE + index] = plies + 1
+                    found.append(index)
+            frontier = found
+        table.flush()
+        longest = max(table[HEADER_SIZE:]) - 1
+    finally:
+        table.close()
+        file.close()
+    os.replace(temporary, filename)
+    return Probe(1, max(longest, 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    generate_parser = subparsers.add_parser('generate', help='generate tables')
+    generate_parser.add_argument('tables', nargs='*', help=f'tables to generate (default {" ".join(SPECS)})')
+    generate_parser.add_argument('--workers', type=int, default=None, help='processes (default one per core)')
+    probe_parser = subparsers.add_parser('probe', help='look a position up')
+    probe_parser.add_argument('--fen', required=True)
+    parser.add_argument('--directory', default=DEFAULT_DIRECTORY, help=f'table directory (default {DEFAULT_DIRECTORY})')
+    args = parser.parse_args()
+
+    if args.command == 'probe':
+        tablebases = Tablebases(args.directory)
+        state = rules.BoardState.from_fen(args.fen)
+        probe = tablebases.probe(state)
+        if probe is None:
+            raise SystemExit('No table covers this position')
+        move, _ = tablebases.best_move(state) or (None, None)
+        print(f'{probe}, best move {move}')
+        return
+    unknown = set(args.tables) - set(SPECS)
+    if unknown:
+        raise SystemExit(f'Unknown tables {" ".join(sorted(unknown))}, choose from {" ".join(SPECS)}')
+    os.makedirs(args.directory, exist_ok=True)
+    # dependencies first, whatever order the tables were asked for in
+    names = [name for name in SPECS if name in args.tables or not args.tables]
+    with multiprocessing.Pool(args.workers) as pool:
+        for name in names:
+            for dependency in SPECS[name].dependencies:
+                if not os.path.exists(table_filename(args.directory, dependency)):
+                    raise SystemExit(f'{name} needs {dependency}, generate it first')
+            start = time.perf_counter()
+            longest = generate(name, args.directory, pool)
+            elapsed = time.perf_counter() - start
+            print(f'{name}: {SPECS[name].size} positions in {elapsed:.1f}s, '
+                  f'{SPECS[name].size / elapsed:,.0f} positions/sec, longest mate {longest.plies} plies')
+
+
+if __name__ == '__main__':
+    main()